@@ -0,0 +1,113 @@
+#!/usr/bin/python
+description='''Time the simulator and the tools for processing its output, with fixed seeds,
+    over all combinations of the given sample sizes, effective population sizes, numbers of populations and numbers of generations,
+    and save the results (throughputs and peak memory usage) as JSON, so that different versions can be compared.
+    Each combination is run in a separate process so that peak memory usage is measured separately.
+
+    Example usage:
+        python benchmark.py -o bench-new.json -c bench-old.json
+'''
+
+from optparse import OptionParser
+import coalpedigree as coal
+import subprocess, os, sys
+import tempfile, shutil
+import time
+import random
+import json
+import resource
+
+parser = OptionParser(description=description)
+parser.add_option("-s","--samplesizes",dest="sampsizes",help="sample sizes (per population) to try, comma-separated",default="50,200")
+parser.add_option("-n","--nesizes",dest="nesizes",help="effective population sizes (per population) to try, comma-separated",default="1000,10000")
+parser.add_option("-d","--ndemes",dest="ndemes",help="numbers of populations to try, comma-separated",default="1,3")
+parser.add_option("-t","--ngens",dest="ngens",help="numbers of generations to try, comma-separated",default="10,20")
+parser.add_option("-r","--seed",dest="seed",help="random seed",default="1234")
+parser.add_option("-o","--outfile",dest="outfile",help="name of file to write results to (or '-' for stdout)",default="-")
+parser.add_option("-c","--compare",dest="compare",help="name of a previous results file to compare to",default=None)
+parser.add_option("-x","--case",dest="case",help="(used internally) run only this case, given as JSON",default=None)
+(options,args) =  parser.parse_args()
+
+scriptdir = os.path.dirname(os.path.abspath(sys.argv[0]))
+
+def timed(f,*args,**kwargs):
+    start = time.time()
+    out = f(*args,**kwargs)
+    return time.time()-start, out
+
+def runcase(case):
+    '''Run one combination of parameters, returning a dict of results.'''
+    random.seed(case["seed"])
+    labels = [ "p"+str(k) for k in xrange(case["ndemes"]) ]
+    sampsizes = dict( [ (x,case["sampsize"]) for x in labels ] )
+    ancne = dict( [ (x,case["ne"]) for x in labels ] )
+    migprobs = dict( [ ((x,y),0.01/max(1,len(labels)-1)) for x in labels for y in labels if x!=y ] )
+    results = {}
+    # picking parents
+    pickparent = coal.ParentSampler(ancne,migprobs)
+    inds = [ coal.maxne*random.randrange(len(labels)) + random.randrange(case["ne"]) for _ in xrange(10**5) ]
+    elapsed,_ = timed( pickparent.pickmany, inds )
+    results["pickparent.per.sec"] = len(inds)/elapsed
+    # crossovers
+    elapsed,_ = timed( coal.recombtable, 10**4 )
+    results["recombtable.meioses.per.sec"] = 10**4/elapsed
+    # the simulation
+    pop = coal.initpop(sampsizes)
+    nsegs = 0
+    elapsed = 0.0
+    for t in xrange(case["ngens"]):
+        nsegs += len(pop.pos)
+        elapsed += timed( coal.parents, pop, ancne, migprobs, t=t )[0]
+    results["parents.seconds"] = elapsed
+    results["parents.segments.per.sec"] = nsegs/elapsed
+    results["segments"] = len(pop.pos)
+    # writing out and processing IBD
+    tmpdir = tempfile.mkdtemp()
+    try:
+        ibdfile = os.path.join(tmpdir,"bench.fibd.gz")
+        logfile = os.path.join(tmpdir,"bench.log")
+        elapsed,_ = timed( coal.writeibd, pop, minlen=0.0, gaplen=0.0, filename=ibdfile )
+        nblocks = sum( 1 for _ in coal.readblocks(coal.fileopt(ibdfile,"r")) )
+        results["blocks"] = nblocks
+        results["writeibd.blocks.per.sec"] = nblocks/elapsed
+        chromfile = open(logfile,"w")
+        chromfile.write("chromosome ending positions: " + str(list(coal.chrpos)+[coal.chrlen]) + "\n")
+        chromfile.close()
+        for name,script,extra in [ ("winnow", "winnow.py", ["-g",".01","-m",".01","-l",os.devnull]), ("removegaps", "remove-gaps-fibd.py", ["-g",".01","-c",logfile]) ]:
+            elapsed,_ = timed( subprocess.check_call, [ sys.executable, os.path.join(scriptdir,script), "-b", ibdfile, "-o", os.path.join(tmpdir,name+".fibd.gz") ] + extra )
+            results[name+".blocks.per.sec"] = nblocks/elapsed
+    finally:
+        shutil.rmtree(tmpdir)
+    # ru_maxrss is in kilobytes (on linux)
+    results["maxrss.MB"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+    results["winnow.maxrss.MB"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024.0
+    return results
+
+if options.case is not None:
+    print json.dumps( runcase( json.loads(options.case) ) )
+    sys.exit(0)
+
+# run all the cases
+ints = lambda x: map( int, x.split(",") )
+cases = [ dict(sampsize=n,ne=ne,ndemes=d,ngens=t,seed=int(options.seed)) for n in ints(options.sampsizes) for ne in ints(options.nesizes) for d in ints(options.ndemes) for t in ints(options.ngens) ]
+githash, giterr = subprocess.Popen(["git",'--git-dir='+os.path.join(scriptdir,'.git'),'rev-parse','HEAD'], stdout=subprocess.PIPE).communicate()
+output = { "githash" : githash.strip(), "date" : time.strftime("%d %h %Y %H:%M:%S", time.localtime()), "python" : sys.version.split()[0], "cases" : [] }
+for case in cases:
+    sys.stderr.write("benchmark: " + json.dumps(case,sort_keys=True) + "\n")
+    result = json.loads( subprocess.Popen( [ sys.executable, os.path.abspath(sys.argv[0]), "-x", json.dumps(case) ], stdout=subprocess.PIPE ).communicate()[0] )
+    output["cases"].append( dict( case, results=result ) )
+
+outfile = coal.fileopt(options.outfile,"w")
+outfile.write( json.dumps(output,sort_keys=True,indent=1) + "\n" )
+outfile.close()
+
+if options.compare is not None:
+    # print the ratio of new to old for each result
+    old = json.load( open(options.compare) )
+    key = lambda case: tuple( case[x] for x in ("sampsize","ne","ndemes","ngens","seed") )
+    oldcases = dict( [ (key(case),case["results"]) for case in old["cases"] ] )
+    sys.stderr.write("benchmark: ratio of new to old (" + str(old["githash"]) + ") results\n")
+    for case in output["cases"]:
+        if key(case) in oldcases:
+            ratios = [ (x,y/oldcases[key(case)][x]) for x,y in sorted(case["results"].iteritems()) if oldcases[key(case)].get(x) ]
+            sys.stderr.write( " ".join(map(str,key(case))) + ": " + ", ".join( [ "%s %.3g" % r for r in ratios ] ) + "\n" )
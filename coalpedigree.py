@@ -16,12 +16,33 @@
 
 
 import random
+import math
 import gzip
 import sys
+import os
+import shutil
+import tempfile
+import multiprocessing
 import bisect
 from collections import defaultdict, Counter
 import heapq
 import itertools as it
+import operator
+import struct
+import time
+import cPickle
+import json
+import zlib
+import mmap
+import threading
+import Queue
+import weakref
+import atexit
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # chrlen = 1.0 # chromosome length
 # Default: human chromosome lengths (almost all of them)
@@ -32,39 +53,110 @@ chrlen = sum(chrlens)  # the last one (total length)
 # this is actually the number of parents... so it will work (?) for ploidy=4 but will not be biological.
 ploidy = 2
 
-# this number should be larger than Ne will ever be
-maxne = 10**8  # since maximum integer size on some machines is 2**31, this restricts us to at most 21 populations?
+# this number should be larger than Ne will ever be:
+#   chromosome IDs are maxne*(population) + (chromosome within population), held in anctype arrays (see maxdemes)
+maxne = 10**8
 
-def initpop(sampsizes):
-    '''A pop is list of [ maternal chrom, paternal chrom ]s
+# for passing things to forked worker processes
+_forked = {}
+
+# if numpy is available, use it to choose crossovers and split segments for a whole generation at once
+#   (see recombtable and recombinebatch); set this to False to use the pure python versions
+usenumpy = numpy is not None
+# how many meioses recombtable and recombinebatch work on at once with numpy
+recombchunk = 2**14
+
+# typecodes for the arrays holding breakpoint positions, ancestral chromosomes, and offsets
+postype = 'd'
+anctype = 'l'
+
+# the most populations that fit in anctype's IDs: about 9*10**10 where longs are 64-bit, but only 21 where they are 32-bit
+maxdemes = ( 2**(8*array(anctype).itemsize-1) - 1 ) // maxne
+
+class Pop(object):
+    '''The sampled chromosomes, stored as contiguous arrays:
+       chromosome c ( = ploidy*ind + ii for the ii-th chromosome of diploid ind ) is
+       pos[offsets[c]:offsets[c+1]] (in order) and anc[offsets[c]:offsets[c+1]],
+       with anc[k] the ancestral chromosome of [pos[k],pos[k+1]).
+       Adjacent segments with the same ancestral chromosome are merged by parents();
+       merged is the total number of segments removed this way.
+       If window = (left,right) is not None, only that part of the genome is being followed.
+    '''
+    def __init__(self,pos,anc,offsets,merged=0,window=None):
+        self.pos = pos
+        self.anc = anc
+        self.offsets = offsets
+        self.merged = merged
+        self.window = window
+
+    def __len__(self):
+        # number of diploid individuals
+        return (len(self.offsets)-1)//ploidy
+
+    def __getitem__(self,ind):
+        '''A copy of diploid ind in the old format: [ [ [pos_i], [anc_i] ] for each chromosome ].'''
+        if ind < 0 or ind >= len(self):
+            raise IndexError("Pop index out of range")
+        return [ list(self.chrom(ploidy*ind+ii)) for ii in xrange(ploidy) ]
+
+    def nchroms(self):
+        return len(self.offsets)-1
+
+    def bounds(self):
+        '''The (left,right) ends of the part of the genome being followed.'''
+        return self.window if self.window is not None else (0.0,chrlen)
+
+    def chrom(self,c):
+        '''Return ( [pos_i], [anc_i] ) for chromosome c.'''
+        a,b = self.offsets[c],self.offsets[c+1]
+        return self.pos[a:b].tolist(), self.anc[a:b].tolist()
+
+    def segments(self,c):
+        '''Iterate over (pos,anc) along chromosome c.'''
+        pos,anc = self.pos,self.anc
+        for k in xrange(self.offsets[c],self.offsets[c+1]):
+            yield pos[k],anc[k]
+
+
+def initpop(sampsizes,window=None):
+    '''A pop is a Pop holding, in order, maternal and paternal chromosomes of each individual;
           chromsomes are two lists, [ pos_i ] (in order) and [ anc_i ], with anc_i the ancestral chromosome of [pos_i,pos_i+1).
        Sampled diploid individual n in population k has chromosomes numbers k*maxne + ploidy*n ... k*maxne + (ploidy+1)*n-1.
+       If window = (left,right) is given, only follow that part of the genome:
+       with the same seed (see meiosistable), this gives the same result there as simulating the whole genome.
     '''
     ordlabs = sorted(sampsizes.keys())  # ensure consistent order
+    if len(ordlabs) > maxdemes:
+        raise ValueError("initpop: too many populations for the IDs (see maxdemes).")
+    if window is not None and not ( len(window) == 2 and 0.0 <= window[0] < window[1] <= chrlen ):
+        raise ValueError("initpop: window must be (left,right) with 0 <= left < right <= chrlen.")
     if type(sampsizes)==type({}):
         sampsizes = [ sampsizes[x] for x in ordlabs ]
     diploids = [ k*maxne+j for k in xrange(len(sampsizes)) for j in xrange(sampsizes[k]) ]
-    pop = [ [ [ [ 0.0 ],  [ maxne*(k//maxne)+ploidy*(k%maxne)+j ] ] for j in xrange(ploidy) ] for k in diploids ]
-    return pop
+    nchroms = ploidy*len(diploids)
+    left = window[0] if window is not None else 0.0
+    pos = array(postype,[left])*nchroms
+    anc = array(anctype,[ maxne*(k//maxne)+ploidy*(k%maxne)+j for k in diploids for j in xrange(ploidy) ])
+    offsets = array('l',xrange(nchroms+1))
+    return Pop(pos,anc,offsets,window=window)
 
 
 def census(pop,sampsizes=None):
     '''Return number of individuals and number of breakpoints
-    in each subpopulation.
+    in each subpopulation, and the number of segments removed so far
+    by merging adjacent segments with the same ancestry.
     '''
-    nchroms = sum( map( lambda u: len(u[0][0])+len(u[1][0]), pop ) )
+    nchroms = len(pop.pos)
     subpops = []
     if sampsizes:
         ordlabs = sorted(sampsizes.keys())  # ensure consistent order
         k = 0
         for nsamps in [ sampsizes[x] for x in ordlabs ]:
-            thispop = Counter()
-            for j in xrange(k,k+nsamps):
-                for ii in xrange(ploidy):
-                    thispop.update( getsubpop(pop[j][ii][1],ordlabs) )
+            anc = pop.anc
+            thispop = Counter( ordlabs[anc[j]//maxne] for j in xrange(pop.offsets[ploidy*k],pop.offsets[ploidy*(k+nsamps)]) )
             k = k+nsamps
             subpops.append( thispop )
-    return nchroms, subpops
+    return nchroms, subpops, pop.merged
 
 
 def getsubpop(inds,ordlabs):
@@ -76,17 +168,17 @@ def sanity(pop,sampsizes=None,ancne=None,print_details=False):
     '''Do some sanity checks.
     '''
     errors = []
+    offsets = pop.offsets
+    if len(pop.pos)!=len(pop.anc) or offsets[0]!=0 or offsets[-1]!=len(pop.pos) or len(offsets)!=ploidy*len(pop)+1:
+        print "Oops!  Arrays in pop don't match up."
+        print len(pop.pos), len(pop.anc), len(offsets), offsets[0], offsets[-1]
+        return [None]
     for ind in xrange(len(pop)):
         try:
-            # diploid?
-            if len(pop[ind]) != ploidy:
-                errors.append( ind )
-                if print_details:
-                    print "Oops!  Are we not diploid?"
-                    print ind, pop[ind]
             # all chromosomes of the proper form?
-            for chrom in pop[ind]:
-                if len(chrom)!=2 or len(chrom[0])!=len(chrom[1]) or any( [ (chrom[0][k+1]<=chrom[0][k]) for k in xrange(len(chrom[0])-1) ] ):
+            for c in xrange(ploidy*ind,ploidy*(ind+1)):
+                a,b = offsets[c],offsets[c+1]
+                if b<=a or pop.pos[a]!=pop.bounds()[0] or any( [ (pop.pos[k+1]<=pop.pos[k]) for k in xrange(a,b-1) ] ):
                     errors.append(ind)
                     if print_details:
                         print "Malformed chromosomes?"
@@ -102,190 +194,1957 @@ def sanity(pop,sampsizes=None,ancne=None,print_details=False):
         return errors
 
 
-def getrecombs():
-    # assign crossover locations -- begin with random subset of breaks between chromosomes
-    # crossovers will be a list of crossover locations in increasing order
-    crossovers = [ x for x in chrpos ]
-    z = random.expovariate(1)
-    while z < chrlen :
-        crossovers.append(z)
-        z += random.expovariate(1)
-    crossovers.sort()
-    return crossovers
+def poisson(lam,rand=random.random):
+    '''Draw a Poisson(lam) random number
+    (by transformed rejection, Hormann 1993, for large lam).
+    '''
+    if lam < 10:
+        k = 0
+        p = rand()
+        explam = math.exp(-lam)
+        while p > explam:
+            k += 1
+            p *= rand()
+        return k
+    slam = math.sqrt(lam)
+    loglam = math.log(lam)
+    b = 0.931 + 2.53*slam
+    a = -0.059 + 0.02483*b
+    invalpha = 1.1239 + 1.1328/(b-3.4)
+    vr = 0.9277 - 3.6224/(b-2)
+    while True:
+        u = rand() - 0.5
+        v = rand()
+        us = 0.5 - abs(u)
+        k = math.floor( (2*a/us + b)*u + lam + 0.43 )
+        if us >= 0.07 and v <= vr:
+            return int(k)
+        if k < 0 or (us < 0.013 and v > us):
+            continue
+        if math.log(v) + math.log(invalpha) - math.log(a/(us*us)+b) <= -lam + k*loglam - math.lgamma(k+1):
+            return int(k)
 
 
-def parentfactory(ancne,migprobs):
-    '''Return a function that will pick a random (diploid) parent for a given (diploid) individual.
+def recombtable(n):
+    '''Choose crossover locations for n meioses at once,
+    returning (offsets,values) with the crossovers of the i-th meiosis
+    in increasing order in values[offsets[i]:offsets[i+1]].
+    Crossovers are a rate-one Poisson process along the genome:
+    a Poisson(chrlen) number of them, placed uniformly.
+    The breaks between chromosomes (chrpos) are NOT included.
+    With numpy (see usenumpy), these are drawn in large batches, seeded from random.
+    '''
+    if usenumpy:
+        # the crossovers of each meiosis, in order, are the partial sums of count+1 exponentials,
+        #   scaled to add up to chrlen; done for recombchunk meioses at a time, to not need much more memory than the result
+        rng = numpy.random.RandomState( random.getrandbits(32) )
+        counts = rng.poisson(chrlen,n)
+        offsets = numpy.zeros(n+1,dtype=numpy.int64)
+        numpy.cumsum(counts,out=offsets[1:])
+        values = array(postype,[0.0])*int(offsets[-1])
+        out = numpy.frombuffer(values,dtype=numpy.float64)
+        for start in xrange(0,n,recombchunk):
+            these = counts[start:start+recombchunk]
+            m = len(these)
+            sums = numpy.cumsum( rng.standard_exponential(these.sum()+m) )
+            ends = numpy.cumsum(these+1) - 1
+            starts = numpy.zeros(m)
+            starts[1:] = sums[ends[:-1]]
+            keep = numpy.ones(len(sums),dtype=bool)
+            keep[ends] = False
+            groups = numpy.repeat( numpy.arange(m), these )
+            x = chrlen * (sums[keep]-starts[groups]) / (sums[ends]-starts)[groups]
+            out[offsets[start]:offsets[start+m]] = numpy.minimum( x, numpy.nextafter(chrlen,0) )
+        return array('l',offsets.tolist()), values
+    rand = random.random
+    offsets = array('l',[0])
+    values = array(postype)
+    for _ in xrange(n):
+        crossovers = [ chrlen*rand() for _ in xrange(poisson(chrlen)) ]
+        crossovers.sort()
+        values.extend( crossovers )
+        offsets.append( len(values) )
+    return offsets,values
+
+
+def aliastable(probs):
+    '''Return (cutoffs,aliases) so that choosing k uniformly
+    and then returning k with probability cutoffs[k] and aliases[k] otherwise
+    returns k with probability probs[k] (Walker's alias method).
+    '''
+    n = len(probs)
+    total = float(sum(probs))
+    scaled = [ n*p/total for p in probs ]
+    cutoffs = [ 1.0 ]*n
+    aliases = range(n)
+    small = [ k for k in xrange(n) if scaled[k] < 1.0 ]
+    large = [ k for k in xrange(n) if scaled[k] >= 1.0 ]
+    while small and large:
+        j = small.pop()
+        k = large.pop()
+        cutoffs[j] = scaled[j]
+        aliases[j] = k
+        scaled[k] -= 1.0 - scaled[j]
+        if scaled[k] < 1.0:
+            small.append(k)
+        else:
+            large.append(k)
+    return cutoffs,aliases
+
+
+class ParentSampler(object):
+    '''Picks random (diploid) parents for (diploid) individuals:
+    the parent's population is chosen using an alias table for the individual's population,
+    and then the parent uniformly from within that population.
     Note that migration probabilities are *reverse-time* migration probabilities,
     i.e. migprobs[(x,y)] is the probability that a parent of someone in x is from y.
+    Only the nonzero ones need be given, and each alias table is only over those populations
+    (and x itself), so with many populations (e.g. a stepping-stone grid, see steppingstone)
+    neither setting up nor picking a parent depends on how many there are.
     '''
-    if len(ancne)>1:
-        ordlabs = sorted(ancne.keys())  # ensure consistent order
-        cumprobs = [ [ migprobs.get((x,y),0) for y in ordlabs ] for x in ordlabs ]
+    def __init__(self,ancne,migprobs):
+        self.ordlabs = sorted(ancne.keys())  # ensure consistent order
+        if len(self.ordlabs) > maxdemes:
+            raise ValueError("ParentSampler: too many populations for the IDs (see maxdemes).")
+        self.migprobs = dict(migprobs)
+        self.setne(ancne)
+        index = dict( [ (x,k) for k,x in enumerate(self.ordlabs) ] )
+        rows = [ {} for x in self.ordlabs ]  # rows[k][j] is the probability of going from k to j
+        for (x,y),p in migprobs.iteritems():
+            if p > 0 and x in index and y in index:
+                rows[index[x]][index[y]] = p
         # assign missing probabilities to diagonal
-        totprobs = map( sum, cumprobs )
-        if any([p>1 for p in totprobs]):
-            raise ValueError("Migration probabilities sum to >1, oops!")
-        for k in xrange(len(cumprobs)):
-            cumprobs[k][k] += 1-totprobs[k]
-            cumprobs[k] = [ sum(cumprobs[k][:j+1]) for j in xrange(len(cumprobs[k])) ]
-        def pickparent(ind):
-            y = bisect.bisect_left( cumprobs[ind//maxne], random.random() )
-            return y*maxne + random.sample(xrange(ancne[ordlabs[y]]),1)[0]
+        self.tables = []
+        for k,row in enumerate(rows):
+            totprob = sum(row.itervalues())
+            if totprob > 1 + 1e-12:
+                raise ValueError("Migration probabilities sum to >1, oops!")
+            row[k] = row.get(k,0) + max(0.0,1-totprob)
+            targets = sorted(row.keys())
+            cutoffs,aliases = aliastable( [ row[j] for j in targets ] )
+            self.tables.append( (cutoffs,aliases,targets) )
+
+    def setne(self,ancne):
+        self.ancne = dict(ancne)
+        self.nes = [ ancne[x] for x in self.ordlabs ]
+
+    def __call__(self,ind,rand=random.random):
+        cutoffs,aliases,targets = self.tables[ind//maxne]
+        u = len(cutoffs)*rand()
+        y = int(u)
+        if u-y >= cutoffs[y]:
+            y = aliases[y]
+        y = targets[y]
+        return y*maxne + int(self.nes[y]*rand())
+
+    def pickmany(self,inds):
+        '''Return a list of parents, one for each of inds.'''
+        rand = random.random
+        tables,nes = self.tables,self.nes
+        if len(nes) == 1:
+            ne = nes[0]
+            return [ int(ne*rand()) for ind in inds ]
+        out = []
+        for ind in inds:
+            cutoffs,aliases,targets = tables[ind//maxne]
+            u = len(cutoffs)*rand()
+            y = int(u)
+            if u-y >= cutoffs[y]:
+                y = aliases[y]
+            y = targets[y]
+            out.append( y*maxne + int(nes[y]*rand()) )
+        return out
+
+
+def steppingstone(nrows,ncols,migprob):
+    '''Return (labels,migprobs) for a grid of nrows x ncols populations, labeled "row,col" (counting from zero),
+    where the parent of someone in each is, with probability migprob, from one of its (two to four) neighbours, chosen uniformly.
+    '''
+    label = lambda i,j: str(i)+","+str(j)
+    labels = [ label(i,j) for i in xrange(nrows) for j in xrange(ncols) ]
+    migprobs = {}
+    for i in xrange(nrows):
+        for j in xrange(ncols):
+            nbrs = [ (u,v) for u,v in ((i-1,j),(i+1,j),(i,j-1),(i,j+1)) if 0 <= u < nrows and 0 <= v < ncols ]
+            for u,v in nbrs:
+                migprobs[(label(i,j),label(u,v))] = migprob/len(nbrs)
+    return labels,migprobs
+
+
+_lastsampler = []
+
+def parentfactory(ancne,migprobs):
+    '''Return a ParentSampler that will pick a random (diploid) parent for a given (diploid) individual,
+    reusing the one from last time if ancne and migprobs are unchanged
+    (or just updating its population sizes if only ancne has changed).
+    '''
+    if _lastsampler:
+        sampler = _lastsampler[0]
+        if sampler.migprobs == migprobs and sampler.ordlabs == sorted(ancne.keys()):
+            if sampler.ancne != ancne:
+                sampler.setne(ancne)
+            return sampler
+    sampler = ParentSampler(ancne,migprobs)
+    _lastsampler[:] = [sampler]
+    return sampler
+
+
+class Demography(object):
+    '''A demography given as data rather than code, checked once and then precomputed for each epoch.
+    spec is a dict (e.g. read from JSON by readdemography) with
+        sampsizes -- a dict of sample sizes by population
+        epochs -- a list of epochs, each a dict with
+            start -- the first generation of the epoch (the first is 0; the epoch lasts until the next one starts)
+            ne -- effective population sizes by population: either a number, constant over the epoch;
+                or {"size":n,"rate":r} for n*exp(r*(t-start)); or {"size":n,"end":m}, changing exponentially from n to m
+                by the start of the next epoch.  Every population must be given, except those that have split off (below).
+            migprobs (optional) -- reverse-time migration probabilities, as a dict of dicts:
+                migprobs[x][y] is the probability that a parent of someone in x is from y (the rest stay in x)
+            steppingstone (optional) -- {"nrows":n,"ncols":m,"migprob":p} adds migration on a grid of populations
+                named "row,col" (see steppingstone), before any migprobs
+            splits (optional) -- a dict {x:y} meaning that going back in time, x merges into y:
+                all parents of those in x are in y (from this epoch on, and x need not be given an ne)
+    ancne(t) and migprobs(t) return dicts suitable as ancnefn(t) and migprobs(t) for sim-ibd-pedigree.py;
+    since migprobs is constant over each epoch, parentfactory only builds new parent samplers once per epoch.
+    '''
+    def __init__(self,spec):
+        self.spec = spec
+        unknown = set(spec.keys()) - set(["sampsizes","epochs"])
+        if unknown:
+            raise ValueError("Demography: unknown keys " + str(sorted(unknown)))
+        self.sampsizes = dict( [ (x,int(n)) for x,n in spec["sampsizes"].iteritems() ] )
+        epochs = spec["epochs"]
+        if not epochs or epochs[0].get("start") != 0:
+            raise ValueError("Demography: the first epoch must start at 0.")
+        self.starts = [ int(e["start"]) for e in epochs ]
+        if any( [ s0 >= s1 for s0,s1 in zip(self.starts[:-1],self.starts[1:]) ] ):
+            raise ValueError("Demography: epochs must be in order.")
+        self.labels = sorted( set( self.sampsizes.keys() ).union( *[ e["ne"].keys() for e in epochs ] ) )
+        labelset = set(self.labels)
+        split = {}
+        # for each epoch: constant ancne or None, (size,rate) by population, and migprobs
+        self.epochs = []
+        for k,e in enumerate(epochs):
+            unknown = set(e.keys()) - set(["start","ne","migprobs","splits","steppingstone"])
+            if unknown:
+                raise ValueError("Demography: unknown keys " + str(sorted(unknown)) + " in epoch " + str(k))
+            split.update( e.get("splits",{}) )
+            growth = {}
+            for x in self.labels:
+                ne = e["ne"].get(x, 1 if x in split else None)
+                if ne is None:
+                    raise ValueError("Demography: no ne given for " + str(x) + " in epoch " + str(k))
+                if isinstance(ne,dict):
+                    size = float(ne["size"])
+                    if "end" in ne:
+                        if k+1 == len(epochs):
+                            raise ValueError("Demography: the last epoch can't have an end size.")
+                        rate = math.log(float(ne["end"])/size)/(self.starts[k+1]-self.starts[k])
+                    else:
+                        rate = float(ne.get("rate",0.0))
+                else:
+                    size,rate = float(ne),0.0
+                if not 1 <= size < maxne:
+                    raise ValueError("Demography: bad ne for " + str(x) + " in epoch " + str(k))
+                growth[x] = (size,rate)
+            migprobs = {}
+            if "steppingstone" in e:
+                grid = e["steppingstone"]
+                gridlabels,migprobs = steppingstone( int(grid["nrows"]), int(grid["ncols"]), float(grid["migprob"]) )
+                if not labelset.issuperset(gridlabels):
+                    raise ValueError("Demography: populations in the grid are missing in epoch " + str(k))
+            for x,row in e.get("migprobs",{}).iteritems():
+                for y,p in row.iteritems():
+                    if x not in labelset or y not in labelset or not 0.0 <= p <= 1.0:
+                        raise ValueError("Demography: bad migration probability " + str((x,y,p)) + " in epoch " + str(k))
+                    if x != y:
+                        migprobs[(x,y)] = float(p)
+            for x,y in split.iteritems():
+                if x not in labelset or y not in labelset:
+                    raise ValueError("Demography: bad split " + str((x,y)) + " in epoch " + str(k))
+            if split:
+                migprobs = dict( [ ((u,v),p) for (u,v),p in migprobs.iteritems() if u not in split ] )
+                migprobs.update( [ ((x,y),1.0) for x,y in split.iteritems() ] )
+            totals = defaultdict(float)
+            for (u,v),p in migprobs.iteritems():
+                totals[u] += p
+            # (the rest stay put: ParentSampler fills this in)
+            for x in self.labels:
+                if totals[x] > 1.0 + 1e-12:
+                    raise ValueError("Demography: migration probabilities from " + str(x) + " sum to >1 in epoch " + str(k))
+            constant = dict( [ (x,int(size)) for x,(size,rate) in growth.iteritems() ] ) if all( [ rate == 0.0 for size,rate in growth.itervalues() ] ) else None
+            self.epochs.append( (constant,growth,migprobs) )
+
+    def epoch(self,t):
+        return self.epochs[ bisect.bisect_right(self.starts,t)-1 ]
+
+    def ancne(self,t):
+        constant,growth,migprobs = self.epoch(t)
+        if constant is not None:
+            return constant
+        start = self.starts[ bisect.bisect_right(self.starts,t)-1 ]
+        return dict( [ (x,max(1,int(size*math.exp(rate*(t-start))))) for x,(size,rate) in growth.iteritems() ] )
+
+    def migprobs(self,t):
+        return self.epoch(t)[2]
+
+
+def readdemography(fname):
+    '''Read a Demography from the JSON file fname.'''
+    infile = fileopt(fname,"r")
+    # with plain strings for population names
+    spec = json.loads( infile.read(), object_hook=lambda d: dict( [ (str(k),v) for k,v in d.iteritems() ] ) )
+    infile.close()
+    return Demography(spec)
+
+
+mask64 = 2**64-1
+
+def splitmix(x):
+    '''One step of the splitmix64 generator: a good 64-bit mixing function.'''
+    z = (x + 0x9E3779B97F4A7C15) & mask64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & mask64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & mask64
+    return z ^ (z >> 31)
+
+
+def counterkey(seed,t,a):
+    '''The key for the random numbers used in the meiosis producing chromosome a in generation t.'''
+    return splitmix( splitmix( splitmix( seed & mask64 ) ^ (t & mask64) ) ^ (a & mask64) )
+
+
+def meiosistable(ancestors,ancne,migprobs,t=0,seed=None,metrics=None):
+    '''Each haploid (e.g. a in ancestors) is the product of a unique meiosis (between chromosomes of its parent);
+    choose these, returning (meioses,recoffsets,recombs) with meioses[a] = (i,base),
+    where the crossovers in that meiosis are recombs[recoffsets[i]:recoffsets[i+1]],
+    and base+j is the j-th chromosome of the parent.
+    If seed is given, the parent and crossovers of each a are instead a function only of (seed,t,a),
+    using random numbers seeded by counterkey(seed,t,a), so don't depend on what else is in ancestors.
+    If metrics is a dict, add to metrics["pick"] and metrics["recomb"] the time spent picking parents and crossovers
+    (with a seed these are done together, and all counted as "pick").
+    '''
+    starttime = time.time()
+    pickparent = parentfactory(ancne,migprobs)  # to choose parents
+    ancestors = sorted(ancestors)
+    if seed is None:
+        recoffsets,recombs = recombtable(len(ancestors))
+        recombtime = time.time()
+        mapas = pickparent.pickmany( [ maxne*(a//maxne)+(a%maxne)//ploidy for a in ancestors ] )  # pickparent wants diploid indices
     else:
-        def pickparent(ind):
-            return random.sample(xrange(ancne.values()[0]),1)[0]
-    return pickparent
+        recombtime = starttime
+        recoffsets = array('l',[0])
+        recombs = array(postype)
+        mapas = []
+        rng = random.Random()
+        rand = rng.random
+        for a in ancestors:
+            rng.seed( counterkey(seed,t,a) )
+            mapas.append( pickparent( maxne*(a//maxne)+(a%maxne)//ploidy, rand ) )
+            crossovers = [ chrlen*rand() for _ in xrange(poisson(chrlen,rand)) ]
+            crossovers.sort()
+            recombs.extend( crossovers )
+            recoffsets.append( len(recombs) )
+    meioses = dict( it.izip( ancestors, it.izip( it.count(), [ maxne*(mapa//maxne) + (mapa%maxne)*ploidy for mapa in mapas ] ) ) )
+    if metrics is not None:
+        metrics["recomb"] = metrics.get("recomb",0.0) + recombtime - starttime
+        metrics["pick"] = metrics.get("pick",0.0) + time.time() - recombtime
+    return meioses,recoffsets,recombs
 
 
-def parents(pop,ancne,migprobs,t=0,ibdict=None,writeto=None):
+def writesharing(intervals,writeblock):
+    '''Write out (with writeblock, see blockwriter) new IBD among the (start,end,carriers,key) intervals that have just landed on the same ancestral chromosome:
+    the sample chromosomes in carriers of overlapping intervals with different keys begin to share over the overlap
+    (those with the same key already did).  Since IBD once formed persists, these blocks are final,
+    but blocks formed in different generations may abut and so together make up a single block.
+    '''
+    intervals.sort( key=operator.itemgetter(0) )
+    active = []
+    for x in intervals:
+        active = [ y for y in active if y[1] > x[0] ]
+        for y in active:
+            if y[3] != x[3]:
+                end = min(x[1],y[1])
+                for c1 in x[2]:
+                    for c2 in y[2]:
+                        writeblock( min(c1,c2), max(c1,c2), x[0], end )
+        active.append(x)
+
+
+def parents(pop,ancne,migprobs,t=0,ibdict=None,writeto=None,seed=None,nprocs=1,metrics=None):
     '''Reallocate each chromosome to the ancestors,
     and then recombine within each individual to resolve the mat/pat chromosomes.
-    Optionally, write out to writeto rather than recording in ibdict.
+    This is done for the whole generation at once: first each distinct ancestral chromosome
+    is assigned a parent and the crossovers of the meiosis that produced it,
+    and then each segment is split at the crossovers falling in it by binary search
+    (or, if usenumpy and not writing out IBD, all segments at once by recombinebatch).
+    Optionally, write out to writeto any new IBD formed this generation (see writesharing).
+    If seed is given, use reproducible random numbers (see meiosistable);
+    then nprocs > 1 splits the sample chromosomes across that many processes,
+    with the same result regardless of nprocs.
+    If metrics is a dict, fill it in with: the time spent in each phase ("pick", "recomb", see meiosistable,
+    and "search", for splitting segments; these are summed over processes), the number of "ancestors" and "crossovers"
+    in the meiosis table (also summed over processes), the new number of "segments",
+    and the number of these inherited from each population ("demes").
     '''
-    parentdict = {}  # this is of the form chrom: diploid parent
-    pickparent = parentfactory(ancne,migprobs)  # function to choose a parent
-    recombdict = defaultdict(getrecombs)  # this is of the form diploid indiv: [recomb locs]
-    for ind in xrange(len(pop)):
-        for ii in xrange(ploidy):
-            pos,anc = pop[ind][ii]
-            newpos = []
-            newanc = []
-            for k in xrange(len(pos)):
-                try:
-                    # anc[k] is the current ancestral chromosome; mapa is the diploid parent that chromosome came from
-                    mapa = parentdict[ anc[k] ]
-                except KeyError:
-                    mapa = parentdict[ anc[k] ] = pickparent(maxne*(anc[k]//maxne)+(anc[k]%maxne)//ploidy)  # pickparent wants a diploid index
-                # each haploid (e.g. anc[k]) is the product of a unique meiosis (between chromosomes of mapa)
-                recombs = recombdict[ anc[k] ]
-                # recombs[0] < ... < recombs[whichseg-1] < pos[k] <= recombs[whichseg]
-                whichseg = bisect.bisect_left( recombs, pos[k] )
-                if whichseg == len(recombs) or pos[k] != recombs[whichseg]:
-                    newpos.append( pos[k] )
-                    newanc.append( maxne*(mapa//maxne) + (mapa%maxne)*ploidy + (whichseg%ploidy) )
-                while whichseg < len(recombs) and ( k == (len(pos)-1) or recombs[whichseg] < pos[k+1] ):
-                    newpos.append( recombs[whichseg] )
-                    whichseg += 1
-                    newanc.append( maxne*(mapa//maxne) + (mapa%maxne)*ploidy + (whichseg%ploidy) )
-            pop[ind][ii] = newpos,newanc
+    starttime = time.time()
+    ordlabs = sorted(ancne.keys())  # as in ParentSampler
+    demecounts = [0]*len(ordlabs)
+    if metrics is None:
+        metrics = {}
+    # if writing out new IBD, sharing[newid] = [ (start,end,(c,),a) ] for each piece of chromosome c that
+    #  had ancestral chromosome a and now has newid
+    sharing = defaultdict(list) if writeto is not None else None
+    newpos = array(postype)
+    newanc = array(anctype)
+    newoffsets = array('l',[0])
+    if nprocs > 1:
+        if seed is None:
+            raise ValueError("parents: need a seed to work in parallel.")
+        nchroms = pop.nchroms()
+        nchunks = min( nchroms, 4*nprocs )
+        bounds = [ (k*nchroms)//nchunks for k in xrange(nchunks+1) ]
+        tasks = [ (c0,c1,ancne,migprobs,t,seed,sharing is not None,len(ordlabs)) for c0,c1 in it.izip(bounds[:-1],bounds[1:]) ]
+        _forked["pop"] = pop
+        try:
+            pool = multiprocessing.Pool(nprocs)
+            results = pool.map( _parentschunk, tasks, chunksize=1 )
+            pool.close()
+            pool.join()
+        finally:
+            del _forked["pop"]
+        nmerged = 0
+        for chunkpos,chunkanc,chunkoffsets,chunkmerged,chunksharing,chunkdemes,chunkmetrics in results:
+            base = len(newpos)
+            newpos.fromstring( chunkpos )
+            newanc.fromstring( chunkanc )
+            newoffsets.extend( [ base+x for x in array('l',chunkoffsets)[1:] ] )
+            nmerged += chunkmerged
+            demecounts = map( operator.add, demecounts, chunkdemes )
+            for key,value in chunkmetrics.iteritems():
+                metrics[key] = metrics.get(key,0) + value
+            if sharing is not None:
+                for newid,these in chunksharing.iteritems():
+                    sharing[newid].extend( these )
+    else:
+        meioses,recoffsets,recombs = meiosistable(set(pop.anc),ancne,migprobs,t=t,seed=seed,metrics=metrics)
+        metrics.update( ancestors=len(meioses), crossovers=len(recombs) )
+        searchtime = time.time()
+        if usenumpy and sharing is None:
+            newpos,newanc,newoffsets,nmerged,demecounts = recombinebatch(pop,meioses,recoffsets,recombs,len(ordlabs))
+        else:
+            nmerged = recombine(pop,0,pop.nchroms(),meioses,recoffsets,recombs,newpos,newanc,newoffsets,sharing,demecounts)
+        metrics["search"] = time.time() - searchtime
+        del meioses,recoffsets,recombs
+    pop.pos,pop.anc,pop.offsets = newpos,newanc,newoffsets
+    pop.merged += nmerged
+    metrics.update( segments=len(newpos), demes=dict(zip(ordlabs,demecounts)) )
+    if sharing is not None:
+        writeblock = blockwriter(writeto)
+        for these in sharing.itervalues():
+            if len(these) > 1:
+                writesharing(these,writeblock)
+    metrics["wall"] = time.time() - starttime
     # all done!
     return None
 
 
+def recombine(pop,cstart,cend,meioses,recoffsets,recombs,newpos,newanc,newoffsets,sharing=None,demecounts=None):
+    '''Do the work of parents() for chromosomes cstart,...,cend-1 of pop,
+    appending their new segments to newpos and newanc and their ends to newoffsets,
+    recording new pieces in sharing (if not None),
+    and adding to demecounts[k] the number of new segments whose ancestor is in population k.
+    Returns the number of segments merged with the previous one.
+    '''
+    if demecounts is None:
+        demecounts = defaultdict(int)
+    pos,anc,offsets = pop.pos,pop.anc,pop.offsets
+    bisect_right = bisect.bisect_right
+    posappend,ancappend = newpos.append,newanc.append
+    nchrpos = len(chrpos)
+    right = pop.bounds()[1]
+    nmerged = 0
+    for c in xrange(cstart,cend):
+        start,end = offsets[c],offsets[c+1]
+        # each segment is [p,q); the parental chromosome it begins on is determined by
+        #   the number of crossovers (w-lo) and of chromosome breaks (nb) at or before p,
+        #   and it must be split at any of these falling in (p,q)
+        nb = 0
+        lastid = None
+        for a,p,q in it.izip( anc[start:end], pos[start:end], it.chain( pos[start+1:end], (right,) ) ):
+            i,base = meioses[a]
+            lo,hi = recoffsets[i],recoffsets[i+1]
+            w = bisect_right( recombs, p, lo, hi )
+            while nb < nchrpos and chrpos[nb] <= p:
+                nb += 1
+            newid = base + (w-lo+nb)%ploidy
+            if newid == lastid and not (nb > 0 and chrpos[nb-1] == p):
+                # same ancestry as the previous segment, so merge them
+                #   (but keep the breaks between chromosomes)
+                nmerged += 1
+            else:
+                posappend( p )
+                ancappend( newid )
+                demecounts[newid//maxne] += 1
+            lastid = newid
+            if (w < hi and recombs[w] < q) or (nb < nchrpos and chrpos[nb] < q):
+                # there are breaks in this segment
+                breaks = recombs[w:bisect_right(recombs,q,w,hi)].tolist() + [ x for x in chrpos[nb:] if x < q ]
+                breaks.sort()
+                for k,x in enumerate(breaks,w-lo+nb+1):
+                    if sharing is not None:
+                        sharing[lastid].append( (p,x,(c,),a) )
+                        p = x
+                    posappend( x )
+                    ancappend( base + k%ploidy )
+                    demecounts[base//maxne] += 1
+                    lastid = base + k%ploidy
+            if sharing is not None:
+                sharing[lastid].append( (p,q,(c,),a) )
+        newoffsets.append( len(newpos) )
+    return nmerged
+
+
+def _ranges(starts,counts):
+    # the concatenation of arange(starts[k],starts[k]+counts[k]) over k
+    total = counts.sum()
+    if total == 0:
+        return numpy.zeros(0,dtype=numpy.int64)
+    shifts = numpy.repeat( starts - numpy.cumsum(counts) + counts, counts )
+    return shifts + numpy.arange(total)
 
-def writeibd(pop,minlen=0.0,gaplen=0.0,filename="coalpedigree.ibd.gz",simplify=True,outfile=None):
-    '''Write out pairwise IBD info from the output of collectibd,
-    restricting to segments at least minlen long OR at least as close as gaplen to another segment,
-    and optionally simplifying by pasting together adjacent blocks shared with the same individual.
 
-    Do this by stepping along the genome in parallel along all chromosomes.
+def _toarray(typecode,values):
+    # a copy of the numpy array values as an array of this typecode
+    out = array(typecode,[0])*len(values)
+    if len(values) > 0:
+        numpy.frombuffer(out,dtype=numpy.dtype(typecode))[:] = values
+    return out
+
+
+def _countupto(values,valoffsets,groups,queries):
+    # for each k, the number of values[valoffsets[g]:valoffsets[g+1]] that are <= queries[k], with g = groups[k]
+    #   (each run of values being sorted, and all in [0,chrlen]):
+    #   search for g*width+queries[k] in the (nondecreasing) g*width+values,
+    #   which can only overcount (by rounding), so then step back as needed;
+    #   this is done for recombchunk groups at a time, so the keys take little memory
+    ngroups = len(valoffsets)-1
+    if ngroups > recombchunk:
+        out = numpy.empty(len(queries),dtype=numpy.int64)
+        chunks = groups//recombchunk
+        order = numpy.argsort(chunks,kind="mergesort")
+        bounds = numpy.searchsorted( chunks[order], numpy.arange((ngroups-1)//recombchunk+2) )
+        del chunks
+        for c in xrange(len(bounds)-1):
+            these = order[bounds[c]:bounds[c+1]]
+            g0, g1 = c*recombchunk, min(ngroups,(c+1)*recombchunk)
+            v0 = valoffsets[g0]
+            out[these] = _countupto( values[v0:valoffsets[g1]], valoffsets[g0:g1+1]-v0, groups[these]-g0, queries[these] )
+        return out
+    width = 2*chrlen
+    lo = valoffsets[groups]
+    keys = numpy.repeat( numpy.arange(ngroups)*width, numpy.diff(valoffsets) )
+    keys += values
+    idx = numpy.minimum( numpy.searchsorted( keys, groups*width+queries, side="right" ), valoffsets[groups+1] )
+    del keys
+    active = numpy.nonzero( idx > lo )[0]
+    while len(active) > 0:
+        active = active[ values[idx[active]-1] > queries[active] ]
+        idx[active] -= 1
+        active = active[ idx[active] > lo[active] ]
+    return idx - lo
+
+
+def recombinebatch(pop,meioses,recoffsets,recombs,ndemes):
+    '''Do the work of recombine() for all of pop at once with numpy (but without recording sharing),
+    returning (newpos,newanc,newoffsets,nmerged,demecounts); the result is the same.
     '''
-    if outfile is None:
-        outfile = fileopt(filename,"w")
-        newfile = True
+    pos = numpy.frombuffer(pop.pos,dtype=numpy.float64)
+    anc = numpy.frombuffer(pop.anc,dtype=numpy.dtype(anctype))
+    offsets = numpy.frombuffer(pop.offsets,dtype=numpy.dtype('l')).astype(numpy.int64)
+    nchroms = len(offsets)-1
+    nsegs = len(pos)
+    if nsegs == 0:
+        return array(postype), array(anctype), array('l',pop.offsets), 0, [0]*ndemes
+    recoffsets = numpy.frombuffer(recoffsets,dtype=numpy.dtype('l')).astype(numpy.int64)
+    recombs = numpy.frombuffer(recombs,dtype=numpy.float64)
+    breaks = numpy.array(chrpos,dtype=numpy.float64)
+    # each segment is [p,q) on chromosome c, and gets meiosis i
+    segchrom = numpy.repeat( numpy.arange(nchroms), numpy.diff(offsets) )
+    p = pos
+    q = numpy.empty(nsegs)
+    q[:-1] = pos[1:]
+    q[offsets[1:]-1] = pop.bounds()[1]
+    ancestors = numpy.array( sorted(meioses.keys()), dtype=anc.dtype )
+    meiosis = numpy.array( [ meioses[a][0] for a in ancestors.tolist() ], dtype=numpy.int64 )
+    bases = numpy.array( [ meioses[a][1] for a in ancestors.tolist() ], dtype=numpy.int64 )
+    # searching in order of ancestor (and so of meiosis) is much quicker, as it keeps to one part of the array at a time
+    order = numpy.argsort(anc)
+    which = numpy.empty(nsegs,dtype=numpy.int64)
+    which[order] = numpy.searchsorted(ancestors,anc[order])
+    i, base = meiosis[which], bases[which]
+    # crossovers at or before p, and at or before q; chromosome breaks at or before p, and before q
+    wp, wq = numpy.empty(nsegs,dtype=numpy.int64), numpy.empty(nsegs,dtype=numpy.int64)
+    wp[order] = _countupto(recombs,recoffsets,i[order],p[order])
+    wq[order] = _countupto(recombs,recoffsets,i[order],q[order])
+    del order
+    nbp = numpy.searchsorted(breaks,p,side="right")
+    nbq = numpy.searchsorted(breaks,q,side="left")
+    # the pieces of each segment: it begins at p, then at each crossover, then at each chromosome break, in (p,q)
+    nrec, nchr = wq-wp, numpy.maximum(nbq-nbp,0)
+    npieces = 1 + nrec + nchr
+    firstpiece = numpy.cumsum(npieces) - npieces
+    piecevals = numpy.empty(npieces.sum())
+    piecevals[firstpiece] = p
+    piecevals[ _ranges(firstpiece+1,nrec) ] = recombs[ _ranges(recoffsets[i]+wp,nrec) ]
+    piecevals[ _ranges(firstpiece+1+nrec,nchr) ] = breaks[ _ranges(nbp,nchr) ]
+    for k in numpy.nonzero( (nchr > 0) & (nrec > 0) )[0].tolist():
+        # so these need putting in order
+        piecevals[firstpiece[k]:firstpiece[k]+npieces[k]].sort()
+    del q, which, wq, nbq, nrec, nchr
+    pieceseg = numpy.repeat( numpy.arange(nsegs), npieces )
+    rank = numpy.arange(len(piecevals)) - firstpiece[pieceseg]
+    pieceanc = base[pieceseg] + ( (wp+nbp)[pieceseg] + rank ) % ploidy
+    # the first piece of a segment is merged with the last piece of the one before
+    #   if it is on the same chromosome, has the same ancestor, and does not begin at a chromosome break
+    merge = numpy.zeros(len(piecevals),dtype=bool)
+    if nsegs > 1:
+        lastanc = pieceanc[ firstpiece[1:]-1 ]
+        atbreak = numpy.zeros(nsegs-1,dtype=bool)
+        hasbreak = nbp[1:] > 0
+        atbreak[hasbreak] = breaks[ nbp[1:][hasbreak]-1 ] == p[1:][hasbreak]
+        merge[ firstpiece[1:] ] = ( segchrom[1:] == segchrom[:-1] ) & ( pieceanc[firstpiece[1:]] == lastanc ) & ~atbreak
+    keep = ~merge
+    newpos = _toarray( postype, piecevals[keep] )
+    del piecevals
+    newanc = pieceanc[keep]
+    del pieceanc
+    newoffsets = _toarray( 'l', numpy.searchsorted( segchrom[pieceseg[keep]], numpy.arange(nchroms+1) ) )
+    demecounts = numpy.bincount( newanc//maxne, minlength=ndemes ).tolist()
+    return newpos, _toarray(anctype,newanc), newoffsets, int(merge.sum()), demecounts
+
+
+def _parentschunk(args):
+    # parents() for one range of chromosomes, in a worker process
+    cstart,cend,ancne,migprobs,t,seed,streaming,ndemes = args
+    pop = _forked["pop"]
+    metrics = {}
+    meioses,recoffsets,recombs = meiosistable(set(pop.anc[pop.offsets[cstart]:pop.offsets[cend]]),ancne,migprobs,t=t,seed=seed,metrics=metrics)
+    metrics.update( ancestors=len(meioses), crossovers=len(recombs) )
+    sharing = defaultdict(list) if streaming else None
+    newpos = array(postype)
+    newanc = array(anctype)
+    newoffsets = array('l',[0])
+    demecounts = [0]*ndemes
+    searchtime = time.time()
+    nmerged = recombine(pop,cstart,cend,meioses,recoffsets,recombs,newpos,newanc,newoffsets,sharing,demecounts)
+    metrics["search"] = time.time() - searchtime
+    return newpos.tostring(), newanc.tostring(), newoffsets.tostring(), nmerged, (dict(sharing) if streaming else None), demecounts, metrics
+
+
+class Lineages(object):
+    '''The ancestry of the sample, stored by distinct ancestral lineage rather than by sample chromosome:
+       lineage k is the interval [start[k],end[k]) of ancestral chromosome anc[k],
+       which has been inherited by each of the sample chromosomes (numbered as in Pop) in the frozenset carriers[k].
+       Sample chromosomes whose ancestry has coalesced share a lineage,
+       so the work per generation scales with the number of lineages rather than with the number of sample segments.
+       As for Pop, window is the part of the genome being followed (if not all of it).
+    '''
+    def __init__(self,start,end,anc,carriers,nchroms,window=None):
+        self.start = start
+        self.end = end
+        self.anc = anc
+        self.carriers = carriers
+        self._nchroms = nchroms
+        self.window = window
+
+    def __len__(self):
+        # number of lineages
+        return len(self.anc)
+
+    def nchroms(self):
+        return self._nchroms
+
+
+def initlineages(sampsizes,window=None):
+    '''As initpop, but returning Lineages.'''
+    pop = initpop(sampsizes,window)
+    nchroms = pop.nchroms()
+    left,right = pop.bounds()
+    return Lineages( array(postype,[left])*nchroms, array(postype,[right])*nchroms, pop.anc, [ frozenset([c]) for c in xrange(nchroms) ], nchroms, window )
+
+
+def lineagecensus(lins,sampsizes=None):
+    '''Return the number of lineages, the number of these in each subpopulation,
+    and the number of sample segments they carry.
+    '''
+    subpops = []
+    if sampsizes:
+        ordlabs = sorted(sampsizes.keys())  # ensure consistent order
+        subpops.append( Counter( ordlabs[a//maxne] for a in lins.anc ) )
+    return len(lins), subpops, sum( map( len, lins.carriers ) )
+
+
+def coalesce(intervals):
+    '''Given a list of (start,end,carriers,...) intervals on the same ancestral chromosome,
+    return disjoint intervals beginning (start,end,carriers) covering the same set, in order,
+    with carriers the union of the carriers of the intervals overlapping each;
+    adjacent ones with the same carriers are merged (but not across breaks between chromosomes).
+    '''
+    intervals.sort( key=operator.itemgetter(0) )
+    lastend = intervals[0][0]
+    for x in intervals:
+        if x[0] < lastend:
+            break
+        lastend = x[1]
     else:
-        newfile = False
-    header = ["id1", "id2", "start", "end"]
-    outfile.write(" ".join(header)+"\n") 
-    chromlist = []  # list of iterators along each chromosome
-    for ind in xrange(len(pop)):
-        chromlist.extend( [ it.izip(pos,anc) for pos,anc in pop[ind] ] )
-    shared = {}.fromkeys(xrange(len(chromlist)))  # ind : { other:pos } where began sharing with other at pos
-    shortones = {}.fromkeys(xrange(len(chromlist)))  # pending short ones that might be appended if there's another soon
-    for ii in shared:
-        shared[ii] = {}
-        shortones[ii] = defaultdict(lambda : [])
-    thestack = [] # next positions for each, sorted
-    pending = {}  # next events occurring at the same junction position
-    for j in xrange(len(chromlist)):
-        heapq.heappush( thestack, (chromlist[j].next(),j) )
-    # initialize current ancestral individual states of each chromosome
-    curstate = [ None ]*len(chromlist)
+        # no overlaps: the usual case
+        return intervals
+    bounds = sorted( set( it.chain.from_iterable( (x[0],x[1]) for x in intervals ) ) )
+    out = []
+    active = []
+    j = 0
+    for b0,b1 in it.izip( bounds[:-1], bounds[1:] ):
+        active = [ x for x in active if x[1] > b0 ]
+        while j < len(intervals) and intervals[j][0] <= b0:
+            active.append( intervals[j] )
+            j += 1
+        if active:
+            carriers = active[0][2] if len(active)==1 else frozenset().union( *[ x[2] for x in active ] )
+            if out and out[-1][1] == b0 and out[-1][2] == carriers and b0 not in chrpos:
+                out[-1] = ( out[-1][0], b1, carriers )
+            else:
+                out.append( (b0,b1,carriers) )
+    return out
+
+
+def lineageparents(lins,ancne,migprobs,t=0,writeto=None,seed=None,metrics=None):
+    '''As parents(), but for Lineages: move each lineage to the parent of its ancestral chromosome,
+    splitting it at the crossovers in the meiosis that produced that chromosome,
+    and combine any lineages that land on overlapping parts of the same parental chromosome.
+    Optionally, write out to writeto any new IBD formed this generation (see writesharing);
+    if seed is given, use reproducible random numbers (see meiosistable).
+    If metrics is a dict, fill it in as for parents(), but with the number of "lineages" rather than segments.
+    '''
+    starttime = time.time()
+    if metrics is None:
+        metrics = {}
+    meioses,recoffsets,recombs = meiosistable(set(lins.anc),ancne,migprobs,t=t,seed=seed,metrics=metrics)
+    metrics.update( ancestors=len(meioses), crossovers=len(recombs) )
+    searchtime = time.time()
+    if writeto is not None:
+        writeblock = blockwriter(writeto)
+    bisect_right = bisect.bisect_right
+    nchrpos = len(chrpos)
+    pieces = defaultdict(list)  # new ancestral chromosome : [ (start,end,carriers,lineage) ]
+    for l,(a,p,q,carriers) in enumerate( it.izip( lins.anc, lins.start, lins.end, lins.carriers ) ):
+        i,base = meioses[a]
+        lo,hi = recoffsets[i],recoffsets[i+1]
+        w = bisect_right( recombs, p, lo, hi )
+        nb = bisect_right( chrpos, p )
+        k = w-lo+nb
+        if (w < hi and recombs[w] < q) or (nb < nchrpos and chrpos[nb] < q):
+            # there are breaks in this lineage
+            breaks = recombs[w:bisect_right(recombs,q,w,hi)].tolist() + [ x for x in chrpos[nb:] if x < q ]
+            breaks.sort()
+            for x in breaks:
+                pieces[ base + k%ploidy ].append( (p,x,carriers,l) )
+                p = x
+                k += 1
+        pieces[ base + k%ploidy ].append( (p,q,carriers,l) )
+    newstart = array(postype)
+    newend = array(postype)
+    newanc = array(anctype)
+    newcarriers = []
+    demecounts = defaultdict(int)
+    for a,these in pieces.iteritems():
+        if len(these) > 1:
+            if writeto is not None:
+                writesharing(these,writeblock)
+            these = coalesce(these)
+        for x in these:
+            newstart.append( x[0] )
+            newend.append( x[1] )
+            newanc.append( a )
+            newcarriers.append( x[2] )
+        demecounts[a//maxne] += len(these)
+    lins.start,lins.end,lins.anc,lins.carriers = newstart,newend,newanc,newcarriers
+    ordlabs = sorted(ancne.keys())
+    metrics.update( search=time.time()-searchtime, wall=time.time()-starttime,
+            lineages=len(newanc), demes=dict( [ (ordlabs[k],n) for k,n in demecounts.iteritems() ] ) )
+    # all done!
+    return None
+
+
+def lineagestopop(lins):
+    '''Return the Pop describing the same ancestry as lins (e.g. to pass to writeibd).'''
+    bychrom = [ [] for c in xrange(lins.nchroms()) ]
+    for p,a,carriers in it.izip( lins.start, lins.anc, lins.carriers ):
+        for c in carriers:
+            bychrom[c].append( (p,a) )
+    pos = array(postype)
+    anc = array(anctype)
+    offsets = array('l',[0])
+    merged = 0
+    for segs in bychrom:
+        segs.sort()
+        lastid = None
+        for p,a in segs:
+            if a == lastid and p not in chrpos:
+                merged += 1
+            else:
+                pos.append( p )
+                anc.append( a )
+            lastid = a
+        offsets.append( len(pos) )
+        del segs[:]
+    return Pop(pos,anc,offsets,merged,lins.window)
+
+
+def ibdblocks(pop,minlen=0.0,gaplen=0.0,window=None):
+    '''Iterate over pairwise IBD blocks (id1,id2,start,end) in pop,
+    pasting together adjacent blocks shared with the same individual but splitting at the ends of chromosomes,
+    and restricting to blocks at least minlen long OR at least as close as gaplen to a following block.
+    If window = (left,right) is given, only look at that part of the genome
+    (so blocks are also split at left and right); the default is all of pop.
+    Blocks ending at a cut -- a side of the window that is inside a chromosome --
+    are returned regardless of length, so that they can be pasted back together (see mergeibd).
+
+    Do this by stepping along the genome in parallel along all chromosomes,
+    keeping track of which chromosomes are currently descended from each ancestral chromosome,
+    so that each change only involves the chromosomes sharing the old or the new ancestor.
+    '''
+    pos,anc,offsets = pop.pos,pop.anc,pop.offsets
+    nchroms = pop.nchroms()
+    if window is None:
+        window = pop.bounds()
+    left,right = window
+    cuts = [ x for x in window if 0.0 < x < chrlen and x not in chrpos ]
+    # initialize current ancestral states of each chromosome, and who holds each
+    firstk = [ bisect.bisect_right(pos,left,offsets[c],offsets[c+1])-1 for c in xrange(nchroms) ]
+    if any( [ firstk[c] < offsets[c] for c in xrange(nchroms) ] ):
+        raise ValueError("ibdblocks: Wrong number of 0.0s found?!?")
+    curstate = [ anc[k] for k in firstk ]
+    holders = defaultdict(set)  # anc : set of chromosomes currently descended from anc
+    for c,a in enumerate(curstate):
+        holders[a].add(c)
+    # shared[i][j] is where the block currently shared by i and j began
+    shared = [ {} for c in xrange(nchroms) ]
+    for these in holders.itervalues():
+        for i in these:
+            for j in these:
+                if i != j:
+                    shared[i][j] = left
+    # pending short blocks that might be written out if there's another soon:
+    #  shortones[(i,j)] = (start,end) with i<j, and expiring is a heap of (end+gaplen,(i,j)) to forget about them
+    shortones = {}
+    expiring = []
+    def endblock(i,j,start,end):
+        # return the blocks to write out now that i and j have stopped sharing at end
+        out = []
+        key = (i,j) if i<j else (j,i)
+        short = shortones.pop(key,None)
+        dogap = ( short is not None ) and ( short[1] > start-gaplen )
+        if dogap:
+            out.append( (i,j)+short )
+        if dogap or end-start > minlen or (cuts and (start in cuts or end in cuts)):
+            out.append( (i,j,start,end) )
+        else:
+            shortones[key] = (start,end)
+            heapq.heappush( expiring, (end+gaplen,key) )
+        return out
+    # next positions for each, sorted
+    nextk = [ k+1 for k in firstk ]
+    thestack = [ (pos[nextk[c]],c) for c in xrange(nchroms) if nextk[c] < offsets[c+1] and pos[nextk[c]] < right ]
+    heapq.heapify(thestack)
     while thestack:
-        (pos,anc),curi = heapq.heappop( thestack )
-        curstate[curi] = anc
-    # sanity
-    if any( [ x is None for x in curstate ]):
-        raise ValueError("writeibd: Wrong number of 0.0s found?!?")
-    # refill thestack
-    for j in xrange(len(chromlist)):
-        try:
-            heapq.heappush( thestack, (chromlist[j].next(),j) )
-        except StopIteration:
-            # ah, nothing more in chromlist[j]
-            pass
-    # initialize sharing segments
-    for i,j in it.ifilter( lambda x: curstate[x[0]]==curstate[x[1]], it.product(xrange(len(curstate)),xrange(len(curstate))) ):
-        if i != j:
-            shared[i][j] = shared[j][i] = 0.0
-    pos = 0.0 # where we're at now
-    while pending or thestack:
         # load all events occurring at the same junction position into pending;
         #   then process each, not dealing with relationships to others still pending.
-        # for each, if anc has changed, must end segments j participates in at pos and begin new ones,
+        x = thestack[0][0]
+        pending = {}
+        while thestack and thestack[0][0] == x:
+            c = heapq.heappop( thestack )[1]
+            k = nextk[c]
+            pending[c] = anc[k]
+            nextk[c] = k = k+1
+            if k < offsets[c+1] and pos[k] < right:
+                heapq.heappush( thestack, (pos[k],c) )
+        atbreak = x in chrpos
+        # forget short blocks too far back to be written out (unless that pair is sharing again already)
+        while expiring and expiring[0][0] <= x:
+            key = heapq.heappop( expiring )[1]
+            short = shortones.get(key)
+            if short is not None and short[1]+gaplen <= x and key[1] not in shared[key[0]]:
+                del shortones[key]
+        # for each, if anc has changed, must end segments it participates in at x and begin new ones,
         #   updating curstate and shared
-        if (not pending) or (thestack and (thestack[0][0][0] == pos)):
-            (pos,anc),curi = heapq.heappop(thestack)
-            pending[curi] = anc
-            try:
-                heapq.heappush( thestack, ( chromlist[curi].next(), curi ) )
-            except StopIteration:
-                pass
-        else:
-            while pending:
-                curi,anc = pending.popitem()
-                if (pos in chrpos) or (curstate[ curi ] != anc):
-                    for j,start in shared[curi].items():
-                        if j not in pending and ((pos in chrpos) or (curstate[j]!=anc)):
-                            # finish off blocks that are not pending
-                            #   and no longer have the same state
-                            #   ... but finish blocks regardless if we're at a chromosome boundary
-                            if j in shortones[curi]:
-                                dogaps = [ shend > start-gaplen for shstart,shend in shortones[curi][j] ]
-                                for shstart,shend in it.compress(shortones[curi][j],dogaps):
-                                    outfile.write( " ".join(map(str,[curi,j,shstart,shend])) + "\n" )
-                                del shortones[j][curi]
-                                del shortones[curi][j]
-                            else:
-                                dogaps = [False]
-                            if any(dogaps) or pos-start > minlen:
-                                # if any( [ (start-z)*(z-pos)>0 for z in chrpos ] ):
-                                #     import pdb; pdb.set_trace()
-                                outfile.write( " ".join(map(str,[curi,j,start,pos])) + "\n" )
-                            else:
-                                shortones[curi][j].append( (start,pos) )
-                                if not curi in shortones[j]:
-                                    shortones[j][curi] = shortones[curi][j]
-                            del shared[curi][j]
-                            del shared[j][curi]
-                    for k in [ k for k in xrange(len(curstate)) if (k != curi) and (k not in pending) and (k not in shared[curi]) and (curstate[k]==anc) ]:
-                        # begin new blocks with other individuals, only if they 
-                        #  don't have a pending state change in the current set of operations,
-                        #  aren't already sharing a block, and have the same state,
-                        shared[curi][k] = shared[k][curi] = pos
-                    # ok, now reset the current state
-                    curstate[curi] = anc
+        while pending:
+            curi,a = pending.popitem()
+            old = curstate[curi]
+            if atbreak or old != a:
+                mine = shared[curi]
+                for j,start in mine.items():
+                    if j not in pending and (atbreak or curstate[j] != a):
+                        # finish off blocks that are not pending
+                        #   and no longer have the same state
+                        #   ... but finish blocks regardless if we're at a chromosome boundary
+                        del mine[j]
+                        del shared[j][curi]
+                        for block in endblock(curi,j,start,x):
+                            yield block
+                for k in holders[a]:
+                    # begin new blocks with other individuals, only if they
+                    #  don't have a pending state change in the current set of operations,
+                    #  aren't already sharing a block, and have the same state,
+                    if k != curi and k not in pending and k not in mine:
+                        mine[k] = shared[k][curi] = x
+                # ok, now reset the current state
+                holders[old].discard(curi)
+                if not holders[old]:
+                    del holders[old]
+                holders[a].add(curi)
+                curstate[curi] = a
     # finish off dangling blocks
-    for i in shared.keys():
-        for j,start in shared[i].items():
+    for i in xrange(nchroms):
+        for j,start in shared[i].iteritems():
             if i<j:
-                if shortones[i][j]:
-                    dogaps = [ shend > start-gaplen for shstart,shend in shortones[i][j] ]
-                    for shstart,shend in it.compress(shortones[i][j],dogaps):
-                        outfile.write( " ".join(map(str,[i,j,shstart,shend])) + "\n" )
-                else:
-                    dogaps = [False]
-                if any(dogaps) or pos-start > minlen:
-                    outfile.write( " ".join(map(str,[i,j,start,chrlen])) + "\n" )
+                for block in endblock(i,j,start,right):
+                    yield block
+
+
+def writeibd(pop,minlen=0.0,gaplen=0.0,filename="coalpedigree.ibd.gz",simplify=True,outfile=None,filters=()):
+    '''Write out pairwise IBD info from pop (see ibdblocks),
+    restricting to segments at least minlen long OR at least as close as gaplen to another segment,
+    and simplifying by pasting together adjacent blocks shared with the same individual.
+    The blocks are passed through each of filters in turn before being written (see parsefilters).
+    '''
+    if outfile is None:
+        outfile = fileopt(filename,"w")
+        newfile = True
+    else:
+        newfile = False
+    header = ["id1", "id2", "start", "end"]
+    outfile.write(" ".join(header)+"\n")
+    writeblock = blockwriter(outfile)
+    for block in applyfilters(ibdblocks(pop,minlen=minlen,gaplen=gaplen),filters):
+        writeblock( *block )
     # all done!
     if newfile:
         outfile.close()
 
 
+def lengthfilter(minlen):
+    '''A filter (see parsefilters) that drops blocks shorter than minlen.'''
+    def filt(blocks):
+        for block in blocks:
+            if block[3]-block[2] >= minlen:
+                yield block
+    return filt
+
+
+def gapfilter(gaplen,chunksize=10**6,tmpdir=None):
+    '''A filter (see parsefilters) that merges blocks with the same rule as winnow.py (see mergegaps),
+    after putting each pair in the order (smaller id, larger id) and sorting (see sortblocks),
+    so giving what winnow.py would (with or without -s) on the blocks in that order.
+    Unlike winnow.py, which treats (i,j) and (j,i) as different pairs, this merges blocks of a pair
+    whichever order its ids were written in (and writeibd writes both), so it can give fewer, longer blocks.
+    '''
+    def filt(blocks):
+        blocks = ( block if block[0] <= block[1] else (block[1],block[0],block[2],block[3]) for block in blocks )
+        for block in mergegaps( sortblocks(blocks,chunksize,tmpdir), gaplen ):
+            yield block[:4]
+    return filt
+
+
+def chromfilter(breaks=None):
+    '''A filter (see parsefilters) that splits blocks at the ends of chromosomes (or at breaks).'''
+    def filt(blocks):
+        return splitblocks( blocks, sorted(breaks) if breaks is not None else list(chrpos) )
+    return filt
+
+
+def parsefilters(spec):
+    '''Turn a description of a chain of filters into a list of filters,
+    each a function taking an iterator over IBD blocks (id1,id2,start,end) and returning another one.
+    spec is a comma-separated list of:
+        minlen=x  -- drop blocks shorter than x (see lengthfilter)
+        gaps=x    -- merge blocks separated by gaps no longer than x (see gapfilter)
+        chroms    -- split blocks at the ends of chromosomes (see chromfilter)
+    so for instance "minlen=.001,gaps=.05,chroms,minlen=.02" is like winnow.py -n .001 -g .05 -m .02
+    and then remove-gaps-fibd.py -g 0, except that pairs are put in order first (see gapfilter).
+    '''
+    filters = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name,_,value = item.partition("=")
+        if name == "minlen":
+            filters.append( lengthfilter(float(value)) )
+        elif name == "gaps":
+            filters.append( gapfilter(float(value)) )
+        elif name == "chroms":
+            filters.append( chromfilter() )
+        else:
+            raise ValueError("Unknown filter: " + item)
+    return filters
+
+
+def applyfilters(blocks,filters):
+    '''Pass the blocks through each of filters in turn.'''
+    for filt in filters:
+        blocks = filt(blocks)
+    return blocks
+
+
+def shardname(filename,k):
+    '''The name of the file for the k-th chromosome (counting from zero) corresponding to filename:
+    e.g. shardname("out.fibd.gz",0) is "out.chr1.fibd.gz".
+    '''
+    if filename.endswith(".gz"):
+        root,gz = filename[:-3],".gz"
+    else:
+        root,gz = filename,""
+    root,ext = os.path.splitext(root)
+    return root + ".chr" + str(k+1) + ext + gz
+
+
+
+def chromwindow(k,window=None):
+    '''The part of the k-th chromosome (counting from zero) in window (by default, all of it),
+    or None if they don't overlap.'''
+    left,right = ( ([0.0]+list(chrpos))[k], (list(chrpos)+[chrlen])[k] )
+    if window is not None:
+        left,right = max(left,window[0]),min(right,window[1])
+    return (left,right) if left < right else None
+
+
+def _writechrom(args):
+    k,fname,minlen,gaplen,header = args
+    window = chromwindow(k,_forked["pop"].window)
+    outfile = fileopt(fname,"w")
+    if header:
+        outfile.write("id1 id2 start end\n")
+    writeblock = blockwriter(outfile)
+    nblocks = 0
+    for block in applyfilters(ibdblocks(_forked["pop"],minlen=minlen,gaplen=gaplen,window=window),_forked["filters"]):
+        writeblock( *block )
+        nblocks += 1
+    outfile.close()
+    return nblocks
+
+
+def writeibdparallel(pop,minlen=0.0,gaplen=0.0,filename="coalpedigree.ibd.gz",nprocs=None,shards=False,filters=()):
+    '''As writeibd, but with each chromosome done by a separate process, nprocs at once
+    (by default, as many as there are cores); these share pop by forking.
+    If shards is True, blocks on the k-th chromosome are written to shardname(filename,k);
+    otherwise, these are put together in order into filename.
+    Note that here gaplen (and any filters) are only applied within chromosomes.
+    Returns the list of files written.
+    '''
+    if filename == "-":
+        raise ValueError("writeibdparallel: need a file name to write to.")
+    chroms = [ k for k in xrange(len(chrpos)+1) if chromwindow(k,pop.window) is not None ]
+    fnames = [ shardname(filename,k) for k in chroms ]
+    _forked["pop"] = pop
+    _forked["filters"] = filters
+    try:
+        pool = multiprocessing.Pool(nprocs)
+        # biggest first
+        tasks = [ (k,fname,minlen,gaplen,shards or k==chroms[0]) for k,fname in sorted( zip(chroms,fnames), key=lambda x: -chrlens[x[0]] ) ]
+        pool.map( _writechrom, tasks, chunksize=1 )
+        pool.close()
+        pool.join()
+    finally:
+        del _forked["pop"]
+        del _forked["filters"]
+    if shards:
+        return fnames
+    if filename.endswith(".fibdx"):
+        # these have an index, so can't just be put end to end
+        outfile = fileopt(filename,"w")
+        for fname in fnames:
+            infile = fileopt(fname,"r")
+            for block in infile.blocks():
+                outfile.writeblock(*block)
+            infile.close()
+            os.remove(fname)
+        outfile.close()
+        return [filename]
+    # gzip files and our binary files can be concatenated (after the first, skipping the magic string)
+    skip = len(ibdmagic) if filename.endswith(".fibdb") else 0
+    outfile = open(filename,"wb")
+    for k,fname in enumerate(fnames):
+        infile = open(fname,"rb")
+        if k>0:
+            infile.read(skip)
+        shutil.copyfileobj(infile,outfile,2**20)
+        infile.close()
+        os.remove(fname)
+    outfile.close()
+    return [filename]
+
+
+def parsebins(spec):
+    '''Turn a description of length bins into the sorted list of their left ends:
+    either a comma-separated list, or "from:to:by", e.g. "0:1:.01".
+    '''
+    if ":" in spec:
+        lo,hi,by = map( float, spec.split(":") )
+        return [ lo+k*by for k in xrange(int(round((hi-lo)/by))+1) ]
+    return sorted( map( float, spec.split(",") ) )
+
+
+def ibdsummary(blocks,sampsizes,bins):
+    '''Summarize IBD blocks (id1,id2,start,end), with chromosomes numbered as in initpop, in a single pass
+    rather than keeping them, returning a dict with:
+        demes -- population labels, in order
+        bins -- left ends of the length bins (the last one has no right end)
+        counts, lengths -- number and total length of blocks shared between each pair of populations ("a-b" with a<=b)
+        histograms -- number of blocks in each length bin, for each pair of populations (blocks shorter than bins[0] are left out)
+        totals -- matrix of total length shared by each pair of sampled individuals (the diagonal is within an individual)
+        nblocks -- total number of blocks
+    '''
+    ordlabs = sorted(sampsizes.keys())  # ensure consistent order
+    demeof = [ k for k,x in enumerate(ordlabs) for j in xrange(ploidy*sampsizes[x]) ]
+    nind = len(demeof)//ploidy
+    pairnames = [ [ "-".join(map(str,sorted([x,y]))) for y in ordlabs ] for x in ordlabs ]
+    npairs = len(ordlabs)**2
+    counts = [0]*npairs
+    lengths = [0.0]*npairs
+    hists = [ [0]*len(bins) for k in xrange(npairs) ]
+    totals = array('d',[0.0])*(nind*nind)
+    nblocks = 0
+    for id1,id2,start,end in blocks:
+        d1,d2 = demeof[id1],demeof[id2]
+        k = min(d1,d2)*len(ordlabs)+max(d1,d2)
+        blen = end-start
+        counts[k] += 1
+        lengths[k] += blen
+        b = bisect.bisect_right(bins,blen)-1
+        if b >= 0:
+            hists[k][b] += 1
+        i,j = id1//ploidy, id2//ploidy
+        totals[i*nind+j] += blen
+        if i != j:
+            totals[j*nind+i] += blen
+        nblocks += 1
+    keep = [ (d1*len(ordlabs)+d2,pairnames[d1][d2]) for d1 in xrange(len(ordlabs)) for d2 in xrange(d1,len(ordlabs)) ]
+    return dict( demes=ordlabs, bins=list(bins), nblocks=nblocks,
+            counts=dict( [ (name,counts[k]) for k,name in keep ] ),
+            lengths=dict( [ (name,lengths[k]) for k,name in keep ] ),
+            histograms=dict( [ (name,hists[k]) for k,name in keep ] ),
+            totals=[ totals[i*nind:(i+1)*nind].tolist() for i in xrange(nind) ] )
+
+
+def addsummaries(x,y):
+    '''Combine two results of ibdsummary on different blocks (with the same populations and bins).'''
+    if x["demes"] != y["demes"] or x["bins"] != y["bins"]:
+        raise ValueError("addsummaries: can't combine summaries with different populations or bins.")
+    return dict( demes=x["demes"], bins=x["bins"], nblocks=x["nblocks"]+y["nblocks"],
+            counts=dict( [ (name,n+y["counts"][name]) for name,n in x["counts"].iteritems() ] ),
+            lengths=dict( [ (name,n+y["lengths"][name]) for name,n in x["lengths"].iteritems() ] ),
+            histograms=dict( [ (name,map(operator.add,h,y["histograms"][name])) for name,h in x["histograms"].iteritems() ] ),
+            totals=[ map(operator.add,u,v) for u,v in zip(x["totals"],y["totals"]) ] )
+
+
+def _summarizechrom(args):
+    k,minlen,gaplen,sampsizes,bins = args
+    window = chromwindow(k,_forked["pop"].window)
+    return ibdsummary( applyfilters(ibdblocks(_forked["pop"],minlen=minlen,gaplen=gaplen,window=window),_forked["filters"]), sampsizes, bins )
+
+
+def writesummary(pop,sampsizes,bins,minlen=0.0,gaplen=0.0,filename="coalpedigree.summary.json",nprocs=1,filters=()):
+    '''Instead of writing out the IBD blocks in pop (as writeibd does), write a summary of them (see ibdsummary) as JSON.
+    If nprocs is more than 1, chromosomes are summarized separately by that many processes, as in writeibdparallel
+    (so gaplen and any filters only apply within chromosomes).
+    Returns the summary.
+    '''
+    if nprocs > 1:
+        chroms = [ k for k in xrange(len(chrpos)+1) if chromwindow(k,pop.window) is not None ]
+        _forked["pop"] = pop
+        _forked["filters"] = filters
+        try:
+            pool = multiprocessing.Pool(nprocs)
+            tasks = [ (k,minlen,gaplen,sampsizes,bins) for k in sorted( chroms, key=lambda k: -chrlens[k] ) ]
+            summary = reduce( addsummaries, pool.imap_unordered( _summarizechrom, tasks ) )
+            pool.close()
+            pool.join()
+        finally:
+            del _forked["pop"]
+            del _forked["filters"]
+    else:
+        summary = ibdsummary( applyfilters(ibdblocks(pop,minlen=minlen,gaplen=gaplen),filters), sampsizes, bins )
+    outfile = fileopt(filename,"w")
+    outfile.write( json.dumps(summary,sort_keys=True) + "\n" )
+    outfile.close()
+    return summary
+
+
+def readblocks(infile,asof=None):
+    '''Iterate over the IBD blocks (id1,id2,start,end) in infile (as returned by fileopt), skipping the header
+    and ignoring any further columns.  If asof is given, the fifth column must be the generation the block formed in
+    (see GenerationTagger), and only blocks with this no more than asof are returned.
+    '''
+    if hasattr(infile,"blocks"):
+        if asof is not None:
+            raise ValueError("readblocks: binary IBD files don't record generations.")
+        for block in infile.blocks():
+            yield block
+        return
+    for line in infile:
+        fields = line.split()
+        if fields[0] == "id1":
+            continue
+        if asof is not None and int(fields[4]) > asof:
+            continue
+        yield int(fields[0]), int(fields[1]), float(fields[2]), float(fields[3])
+
+
+def sortblocks(blocks,chunksize=10**6,tmpdir=None,bystart=False):
+    '''Iterate over the IBD blocks (id1,id2,start,end) in blocks, in sorted order (or if bystart, sorted by (start,id1,id2,end)),
+    holding no more than chunksize of them in memory at once:
+    sorted chunks are written to temporary binary files (see IBDWriter) in tmpdir, which are then merged.
+    '''
+    key = operator.itemgetter(2,0,1,3) if bystart else None
+    chunk = list( it.islice(blocks,chunksize) )
+    chunk.sort(key=key)
+    if len(chunk) < chunksize:
+        # it all fit
+        for block in chunk:
+            yield block
+        return
+    tmpdir = tempfile.mkdtemp(dir=tmpdir)
+    readers = []
+    try:
+        while chunk:
+            fname = os.path.join(tmpdir,"chunk"+str(len(readers))+".fibdb")
+            writer = IBDWriter(fname,level=1)
+            for block in chunk:
+                writer.writeblock(*block)
+            writer.close()
+            readers.append( IBDReader(fname) )
+            chunk = list( it.islice(blocks,chunksize) )
+            chunk.sort(key=key)
+        if bystart:
+            for k,block in heapq.merge( *[ ( (key(b),b) for b in x.blocks() ) for x in readers ] ):
+                yield block
+        else:
+            for block in heapq.merge( *[ x.blocks() for x in readers ] ):
+                yield block
+    finally:
+        for x in readers:
+            x.close()
+        shutil.rmtree(tmpdir)
+
+
+def mergegaps(blocks,gaplen=0.0):
+    '''Given IBD blocks (id1,id2,start,end) sorted by (id1,id2,start), iterate over (id1,id2,start,end,nsegs)
+    obtained by merging together, in one pass, overlapping blocks of the same pair
+    and those separated by a gap of at most gaplen that is shorter than one of the two blocks;
+    nsegs is the number of original blocks merged into each.
+    Each block is compared in turn to the merged blocks so far of its pair, as winnow.py does without -s,
+    and the result is the same (but in order of start within each pair);
+    only those that might still merge with a later block are kept.
+    '''
+    pair, last = None, None
+    pending = []  # [ (start,end,nsegs) ] of this pair that may still change, in the order they're compared to
+    done = []  # heap of (start,end,nsegs) of this pair that won't
+    for id1,id2,start,end in blocks:
+        if last is not None and (id1,id2,start) < last:
+            raise ValueError("mergegaps: blocks are not sorted.")
+        last = (id1,id2,start)
+        if (id1,id2) != pair:
+            if pair is not None:
+                for x in sorted( done + pending ):
+                    yield pair + x
+            pair, pending, done = (id1,id2), [], []
+        nsegs = 1
+        keep = []
+        for x in pending:
+            x0,x1,xn = x
+            if ( x0 <= end and start <= x1 ) or ( x0 <= end+gaplen and start <= x1+gaplen and max(x0-end,start-x1) < max(end-start,x1-x0) ):
+                start,end = min(x0,start),max(x1,end)
+                nsegs += xn
+            else:
+                keep.append(x)
+        keep.append( (start,end,nsegs) )
+        # later blocks start at or after last[2], and can only merge with something ending within gaplen of that
+        #   or of the start of something else they merge with first
+        reach = last[2]
+        live = [False]*len(keep)
+        changed = True
+        while changed:
+            changed = False
+            for k,x in enumerate(keep):
+                if not live[k] and x[1]+gaplen >= reach:
+                    live[k], changed = True, True
+                    reach = min(reach,x[0])
+        pending = []
+        for x,islive in it.izip(keep,live):
+            if islive:
+                pending.append(x)
+            else:
+                heapq.heappush(done,x)
+        # and nothing that is merged later will start before reach
+        while done and done[0][0] < reach:
+            yield pair + heapq.heappop(done)
+    if pair is not None:
+        for x in sorted( done + pending ):
+            yield pair + x
+
+
+def splitblocks(blocks,breaks,tol=0.0):
+    '''Iterate over the IBD blocks (id1,id2,start,end) in blocks, split at any of the positions in breaks (which must be sorted)
+    that are more than tol from either end (e.g. if positions have been rounded by writing them out as text).'''
+    bisect_right,bisect_left = bisect.bisect_right,bisect.bisect_left
+    for block in blocks:
+        id1,id2,start,end = block
+        lo = bisect_right(breaks,start+tol)
+        hi = bisect_left(breaks,end-tol,lo)
+        if lo == hi:
+            yield block
+            continue
+        for x in breaks[lo:hi]:
+            yield (id1,id2,start,x)
+            start = x
+        yield (id1,id2,start,end)
+
+
+def mergeibd(fnames,filename,cuts=(),minlen=0.0):
+    '''Combine IBD files fnames, written by simulations of consecutive windows of the genome
+    split at the positions in cuts (see initpop and ibdblocks), into filename:
+    blocks ending and beginning at a cut are pasted back together,
+    and then any that touch a cut and are not longer than minlen are dropped.
+    (gaplen is not applied across cuts.)
+    '''
+    # cuts might have been written out as text
+    cuts = set( cuts ) | set( [ float(str(x)) for x in cuts ] )
+    outfile = fileopt(filename,"w")
+    outfile.write("id1 id2 start end\n")
+    writeblock = blockwriter(outfile)
+    held = {}  # (pair,cut) : (id1,id2,start) for a block ending at cut that may continue in the next file
+    for fname in fnames:
+        infile = fileopt(fname,"r")
+        for id1,id2,start,end in readblocks(infile):
+            key = ( (id1,id2) if id1<id2 else (id2,id1), )
+            touches = False
+            if start in cuts:
+                id1,id2,start = held.pop( key+(start,), (id1,id2,start) )
+                touches = True
+            if end in cuts:
+                held[key+(end,)] = (id1,id2,start)
+            elif end-start > minlen or not touches:
+                writeblock(id1,id2,start,end)
+        infile.close()
+    for (pair,end),(id1,id2,start) in held.iteritems():
+        if end-start > minlen:
+            writeblock(id1,id2,start,end)
+    outfile.close()
+
+
+ckpmagic = "COALCKP1"
+
+def writecheckpoint(pop,fname,**state):
+    '''Save pop (a Pop or Lineages) along with anything in state (e.g. the generation and random.getstate())
+    to fname: after ckpmagic comes the length of a pickled header, the header, and then the raw arrays.
+    This is written to a temporary file that then replaces fname,
+    so that if something happens while writing, the previous checkpoint is still there.
+    '''
+    if isinstance(pop,Lineages):
+        # store carriers as offsets into one array
+        carrieroffsets = array('l',[0])
+        carrierlist = array('l')
+        for x in pop.carriers:
+            carrierlist.extend( sorted(x) )
+            carrieroffsets.append( len(carrierlist) )
+        arrays = [ pop.start, pop.end, pop.anc, carrieroffsets, carrierlist ]
+        state.update( kind="Lineages", nchroms=pop.nchroms() )
+    else:
+        arrays = [ pop.pos, pop.anc, pop.offsets ]
+        state.update( kind="Pop", merged=pop.merged )
+    state.update( window=pop.window, byteorder=sys.byteorder, arrays=[ (x.typecode,x.itemsize,len(x)) for x in arrays ] )
+    header = cPickle.dumps(state,2)
+    tmpname = fname + ".tmp"
+    outfile = open(tmpname,"wb")
+    outfile.write( ckpmagic )
+    outfile.write( struct.pack("<Q",len(header)) )
+    outfile.write( header )
+    for x in arrays:
+        x.tofile(outfile)
+    outfile.close()
+    os.rename(tmpname,fname)
+
+
+def readcheckpoint(fname):
+    '''Read back a checkpoint written by writecheckpoint, returning (pop,state).'''
+    infile = open(fname,"rb")
+    if infile.read(len(ckpmagic)) != ckpmagic:
+        raise ValueError(fname + " is not a checkpoint file.")
+    hlen, = struct.unpack("<Q",infile.read(8))
+    state = cPickle.loads(infile.read(hlen))
+    arrays = []
+    for typecode,itemsize,n in state.pop("arrays"):
+        x = array(typecode)
+        if x.itemsize != itemsize:
+            raise ValueError("Checkpoint was written on an incompatible machine.")
+        x.fromfile(infile,n)
+        if state["byteorder"] != sys.byteorder:
+            x.byteswap()
+        arrays.append(x)
+    infile.close()
+    kind = state.pop("kind")
+    window = state.pop("window")
+    if kind == "Lineages":
+        start,end,anc,carrieroffsets,carrierlist = arrays
+        carriers = [ frozenset(carrierlist[i:j]) for i,j in it.izip(carrieroffsets[:-1],carrieroffsets[1:]) ]
+        pop = Lineages(start,end,anc,carriers,state.pop("nchroms"),window)
+    else:
+        pos,anc,offsets = arrays
+        pop = Pop(pos,anc,offsets,state.pop("merged"),window)
+    del state["byteorder"]
+    return pop,state
+
+
+def blockwriter(outfile):
+    '''Return a function that writes the IBD block (id1,id2,start,end) to outfile.'''
+    if hasattr(outfile,"writeblock"):
+        return outfile.writeblock
+    def writeblock(id1,id2,start,end):
+        outfile.write( " ".join(map(str,[id1,id2,start,end])) + "\n" )
+    return writeblock
+
+
+class GenerationTagger(object):
+    '''Write IBD blocks to the text file outfile with an extra column, gen, whose value is whatever self.gen is at the time:
+    passed to parents() as writeto, with gen set each generation, this records when each block formed,
+    so that the IBD as of generation T is just the blocks with gen <= T (see readblocks).
+    '''
+    def __init__(self,outfile,gen=None):
+        if hasattr(outfile,"writeblock"):
+            raise ValueError("GenerationTagger: can only add a column to text output.")
+        self.outfile = outfile
+        self.gen = gen
+
+    def writeblock(self,id1,id2,start,end):
+        self.outfile.write( " ".join(map(str,[id1,id2,start,end,self.gen])) + "\n" )
+
+
+def byteshuffle(data,size):
+    '''Rearrange the string data of items of size bytes so that all the first bytes come first, and so on.'''
+    return "".join( [ data[j::size] for j in xrange(size) ] )
+
+
+def byteunshuffle(data,size):
+    '''Undo byteshuffle.'''
+    n = len(data)//size
+    out = bytearray(len(data))
+    for j in xrange(size):
+        out[j::size] = data[j*n:(j+1)*n]
+    return str(out)
+
+
+# compression level for .gz files, and buffer size for reading and writing files
+gziplevel = 6
+iobufsize = 2**20
+
+# writers still open at exit are closed then (as plain and gzip files would be)
+_unclosed = weakref.WeakSet()
+
+def _closeall():
+    for fobj in list(_unclosed):
+        fobj.close()
+
+atexit.register(_closeall)
+
+class BackgroundTask(object):
+    '''Call func on each item put(), in order, in a separate thread
+    (so that e.g. compression, which releases the GIL, overlaps with other work),
+    with at most maxsize items waiting.  Errors are raised in the calling thread at the next put(), wait() or close().
+    '''
+    def __init__(self,func,maxsize=4):
+        self.func = func
+        self.queue = Queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is not None and self.error is None:
+                    self.func(item)
+            except Exception:
+                self.error = sys.exc_info()
+            finally:
+                self.queue.task_done()
+            if item is None:
+                return
+
+    def check(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def put(self,item):
+        self.check()
+        self.queue.put(item)
+
+    def wait(self):
+        '''Wait until everything put so far is done.'''
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+
+
+class GzipWriter(object):
+    '''Write to a gzipped file, collecting text in memory and compressing it in a background thread.'''
+    def __init__(self,fname,level=None,bufsize=None):
+        self.bufsize = bufsize if bufsize is not None else iobufsize
+        self.fobj = open(fname,"wb",self.bufsize)
+        self.gz = gzip.GzipFile(fname,"wb",level if level is not None else gziplevel,self.fobj)
+        self.buf = []
+        self.size = 0
+        self.task = BackgroundTask(self.gz.write)
+        self.closed = False
+        _unclosed.add(self)
+
+    def write(self,text):
+        self.buf.append(text)
+        self.size += len(text)
+        if self.size >= self.bufsize:
+            self.task.put( "".join(self.buf) )
+            self.buf = []
+            self.size = 0
+
+    def flush(self):
+        if self.buf:
+            self.task.put( "".join(self.buf) )
+            self.buf = []
+            self.size = 0
+        self.task.wait()
+        self.gz.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        _unclosed.discard(self)
+        if self.buf:
+            self.task.put( "".join(self.buf) )
+            self.buf = []
+        self.task.close()
+        self.gz.close()
+        self.fobj.close()
+
+    def __del__(self):
+        self.close()
+
+
+class GzipReader(object):
+    '''Read lines from a gzipped file, decompressing ahead in a background thread.'''
+    def __init__(self,fname,bufsize=None):
+        self.bufsize = bufsize if bufsize is not None else iobufsize
+        self.fobj = open(fname,"rb",self.bufsize)
+        self.gz = gzip.GzipFile(fname,"rb",fileobj=self.fobj)
+        self.queue = Queue.Queue(4)
+        self.error = None
+        self.closing = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        self.lines = self.iterlines()
+
+    def _run(self):
+        try:
+            while not self.closing:
+                data = self.gz.read(self.bufsize)
+                if not data:
+                    break
+                self.queue.put(data)
+        except Exception:
+            self.error = sys.exc_info()
+        self.queue.put("")
+
+    def iterlines(self):
+        tail = ""
+        while True:
+            data = self.queue.get()
+            if not data:
+                break
+            lines = (tail+data).split("\n")
+            tail = lines.pop()
+            for line in lines:
+                yield line + "\n"
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        if tail:
+            yield tail
+
+    def __iter__(self):
+        return self.lines
+
+    def next(self):
+        return self.lines.next()
+
+    def readline(self):
+        return next(self.lines,"")
+
+    def read(self):
+        return "".join(self.lines)
+
+    def close(self):
+        self.closing = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self.gz.close()
+        self.fobj.close()
+
+
+# binary IBD files: this, followed by chunks
+ibdmagic = "COALIBD1"
+# each chunk begins with the number of blocks and the compressed length
+chunkhead = struct.Struct("<II")
+
+def packchunk(cols,level=6):
+    '''Return the columns (id1,id2,start,end), as arrays, as a chunk of a binary IBD file (see IBDWriter).'''
+    if sys.byteorder == "big":
+        for x in cols:
+            x.byteswap()
+    data = zlib.compress( "".join( [ byteshuffle(x.tostring(),x.itemsize) for x in cols ] ), level )
+    return chunkhead.pack(len(cols[0]),len(data)) + data
+
+
+def unpackchunk(data,n):
+    '''Undo packchunk, given the compressed data (after the chunkhead) of n blocks.'''
+    data = zlib.decompress(data)
+    cols = []
+    j = 0
+    for typecode in "IIdd":
+        x = array(typecode)
+        x.fromstring( byteunshuffle(data[j:j+n*x.itemsize],x.itemsize) )
+        if sys.byteorder == "big":
+            x.byteswap()
+        cols.append(x)
+        j += n*x.itemsize
+    return tuple(cols)
+
+
+class IBDWriter(object):
+    '''Write IBD blocks in a compact binary format: after ibdmagic come a series of chunks,
+    each a chunkhead followed by the zlib-compressed columns id1, id2 (unsigned 32-bit ints), start, end (doubles),
+    all little-endian, and with each column byte-shuffled (all first bytes, then all second bytes, ...)
+    since that compresses much better.  Text lines "id1 id2 start end" passed to write() are parsed,
+    so this can stand in for a text file.
+    '''
+    def __init__(self,fname,chunksize=2**16,level=6):
+        self.fobj = open(fname,"wb",iobufsize)
+        self.fobj.write(ibdmagic)
+        self.chunksize = chunksize
+        self.level = level
+        self.cols = ( array('I'), array('I'), array('d'), array('d') )
+        # chunks are compressed and written out in the background
+        self.task = BackgroundTask(self._writechunk)
+        self.closed = False
+        _unclosed.add(self)
+
+    def writeblock(self,id1,id2,start,end):
+        id1s,id2s,starts,ends = self.cols
+        id1s.append(id1)
+        id2s.append(id2)
+        starts.append(start)
+        ends.append(end)
+        if len(id1s) >= self.chunksize:
+            self.task.put( self.cols )
+            self.cols = ( array('I'), array('I'), array('d'), array('d') )
+
+    def write(self,text):
+        for line in text.splitlines():
+            fields = line.split()
+            if not fields or fields[0] == "id1":
+                # the header
+                continue
+            if len(fields) != 4:
+                raise ValueError("Binary IBD files can only hold the columns id1 id2 start end.")
+            self.writeblock( int(fields[0]), int(fields[1]), float(fields[2]), float(fields[3]) )
+
+    def _writechunk(self,cols):
+        self.fobj.write( packchunk(cols,self.level) )
+
+    def flush(self):
+        if len(self.cols[0]):
+            self.task.put( self.cols )
+            self.cols = ( array('I'), array('I'), array('d'), array('d') )
+        self.task.wait()
+        self.fobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        _unclosed.discard(self)
+        if len(self.cols[0]):
+            self.task.put( self.cols )
+        self.task.close()
+        self.fobj.close()
+
+
+class IBDReader(object):
+    '''Read a binary IBD file written by IBDWriter, memory-mapped and decompressed a chunk at a time.
+    Iterating over this gives text lines (beginning with a header), so it can stand in for a text file;
+    use chunks() or blocks() to get at the numbers directly.
+    '''
+    def __init__(self,fname):
+        self.fobj = open(fname,"rb")
+        self.map = mmap.mmap(self.fobj.fileno(),0,access=mmap.ACCESS_READ)
+        if self.map[:len(ibdmagic)] != ibdmagic:
+            raise ValueError(fname + " is not a binary IBD file.")
+        # chunkpos[i] = (where the data starts, number of blocks, compressed length)
+        self.chunkpos = []
+        k = len(ibdmagic)
+        while k < len(self.map):
+            n,m = chunkhead.unpack_from(self.map,k)
+            self.chunkpos.append( (k+chunkhead.size,n,m) )
+            k += chunkhead.size + m
+        self.lines = self.iterlines()
+
+    def __len__(self):
+        return sum( [ n for k,n,m in self.chunkpos ] )
+
+    def chunk(self,i):
+        '''Return the columns (id1,id2,start,end) of the i-th chunk, as arrays.'''
+        k,n,m = self.chunkpos[i]
+        return unpackchunk( self.map[k:k+m], n )
+
+    def chunks(self):
+        for i in xrange(len(self.chunkpos)):
+            yield self.chunk(i)
+
+    def blocks(self):
+        '''Iterate over (id1,id2,start,end).'''
+        for cols in self.chunks():
+            for block in it.izip(*cols):
+                yield block
+
+    def iterlines(self):
+        yield "id1 id2 start end\n"
+        for block in self.blocks():
+            yield " ".join(map(str,block)) + "\n"
+
+    def __iter__(self):
+        return self.lines
+
+    def next(self):
+        return self.lines.next()
+
+    def readline(self):
+        return next(self.lines,"")
+
+    def close(self):
+        self.map.close()
+        self.fobj.close()
+
+
+# indexed IBD files: this, followed by chunks (as in binary IBD files), then the index
+ibdxmagic = "COALIBX2"
+# the index has for each chunk: its chromosome, how it is sorted (bypair or bystart),
+#   first and last pair (if by pair), smallest start and largest end, and where it is
+indexentry = struct.Struct("<iBIIIIddQ")
+bypair, bystart = 0, 1
+# and the file ends with the number of chunks and where the index begins
+indextail = struct.Struct("<QQ")
+
+class IBDStoreWriter(object):
+    '''Write IBD blocks to an indexed file that can be queried by pair and by region without reading all of it (see IBDStore).
+    Blocks can be given in any order (to writeblock(), or as text lines to write()), with pairs in either order:
+    they are kept in temporary binary files, one for each chromosome (in tmpdir, by default next to fname),
+    and when this is closed, each pair is put in the order id1 <= id2 and each chromosome is sorted by (id1,id2,start)
+    (see sortblocks, which uses at most sortsize blocks of memory) and written out in chunks of chunksize blocks.
+    If byregion, each chromosome is then written again, sorted by start, so that a region can be read
+    without the rest of its chromosome (this about doubles the size of the file).
+    '''
+    def __init__(self,fname,chunksize=2**12,level=6,tmpdir=None,sortsize=10**6,byregion=True):
+        self.fname = fname
+        self.byregion = byregion
+        self.chunksize = chunksize
+        self.level = level
+        self.sortsize = sortsize
+        self.tmpdir = tempfile.mkdtemp( dir=tmpdir if tmpdir is not None else os.path.dirname(os.path.abspath(fname)) )
+        self.breaks = list(chrpos)
+        self.parts = {}  # chromosome : IBDWriter
+        self.closed = False
+        _unclosed.add(self)
+
+    def writeblock(self,id1,id2,start,end):
+        if id1 > id2:
+            id1,id2 = id2,id1
+        k = bisect.bisect_right(self.breaks,start)
+        if k not in self.parts:
+            self.parts[k] = IBDWriter( os.path.join(self.tmpdir,"chr"+str(k)+".fibdb"), level=1 )
+        self.parts[k].writeblock(id1,id2,start,end)
+
+    def write(self,text):
+        for line in text.splitlines():
+            fields = line.split()
+            if not fields or fields[0] == "id1":
+                # the header
+                continue
+            if len(fields) != 4:
+                raise ValueError("Indexed IBD files can only hold the columns id1 id2 start end.")
+            self.writeblock( int(fields[0]), int(fields[1]), float(fields[2]), float(fields[3]) )
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        _unclosed.discard(self)
+        try:
+            outfile = open(self.fname,"wb",iobufsize)
+            outfile.write(ibdxmagic)
+            index = []
+            def writechunk(k,order,cols):
+                id1s,id2s,starts,ends = cols
+                if order == bypair:
+                    pairs = ( id1s[0], id2s[0], id1s[-1], id2s[-1] )
+                else:
+                    pairs = ( 0, 0, 0, 0 )
+                index.append( (k, order) + pairs + (min(starts), max(ends), outfile.tell()) )
+                outfile.write( packchunk(cols,self.level) )
+            orders = (bypair,bystart) if self.byregion else (bypair,)
+            for k in sorted(self.parts.keys()):
+                self.parts[k].close()
+                for order in orders:
+                    reader = IBDReader( os.path.join(self.tmpdir,"chr"+str(k)+".fibdb") )
+                    cols = ( array('I'), array('I'), array('d'), array('d') )
+                    for block in sortblocks( reader.blocks(), chunksize=self.sortsize, tmpdir=self.tmpdir, bystart=(order==bystart) ):
+                        for x,y in zip(cols,block):
+                            x.append(y)
+                        if len(cols[0]) >= self.chunksize:
+                            writechunk(k,order,cols)
+                            cols = ( array('I'), array('I'), array('d'), array('d') )
+                    if len(cols[0]):
+                        writechunk(k,order,cols)
+                    reader.close()
+            indexstart = outfile.tell()
+            for entry in index:
+                outfile.write( indexentry.pack(*entry) )
+            outfile.write( indextail.pack(len(index),indexstart) )
+            outfile.close()
+        finally:
+            shutil.rmtree(self.tmpdir)
+
+
+class IBDStore(object):
+    '''Read an indexed IBD file written by IBDStoreWriter: query() returns the blocks of a given pair and/or in a given region,
+    decompressing only the chunks that (according to the index) might have some:
+    for a pair, its chunks on each chromosome; and for a region (but no pair), the chunks of blocks starting nearby,
+    if the file was written byregion (otherwise, all chunks on those chromosomes).
+    Like IBDReader, iterating over this gives text lines, and blocks() gives all the blocks,
+    here sorted by (id1,id2,start) (as needed by mergegaps, e.g. for winnow.py -s -r).
+    '''
+    def __init__(self,fname):
+        self.fobj = open(fname,"rb")
+        self.map = mmap.mmap(self.fobj.fileno(),0,access=mmap.ACCESS_READ)
+        if self.map[:len(ibdxmagic)] != ibdxmagic:
+            raise ValueError(fname + " is not an indexed IBD file.")
+        nchunks,indexstart = indextail.unpack_from(self.map,len(self.map)-indextail.size)
+        self.index = [ indexentry.unpack_from(self.map,indexstart+i*indexentry.size) for i in xrange(nchunks) ]
+        self.byregion = any( [ entry[1] == bystart for entry in self.index ] )
+        self.lines = self.iterlines()
+
+    def __len__(self):
+        return sum( [ chunkhead.unpack_from(self.map,entry[-1])[0] for entry in self.index if entry[1] == bypair ] )
+
+    def chunk(self,i):
+        '''Return the columns (id1,id2,start,end) of the i-th chunk, as arrays.'''
+        k = self.index[i][-1]
+        n,m = chunkhead.unpack_from(self.map,k)
+        return unpackchunk( self.map[k+chunkhead.size:k+chunkhead.size+m], n )
+
+    def chroms(self):
+        '''The chromosomes (numbered from zero) that have blocks.'''
+        return sorted( set( [ entry[0] for entry in self.index ] ) )
+
+    def query(self,id1=None,id2=None,left=None,right=None,chrom=None):
+        '''Iterate over the blocks (id1,id2,start,end), with id1 <= id2, that are shared by id1 and id2 (in either order),
+        if these are given, and that overlap [left,right), if either of these are given, and on chromosome chrom, if given;
+        in order by chromosome, and then by (id1,id2,start), or, for a region without a pair in a file written byregion,
+        by (start,id1,id2).
+        '''
+        if (id1 is None) != (id2 is None):
+            raise ValueError("IBDStore.query: give both id1 and id2, or neither.")
+        pair = None if id1 is None else (min(id1,id2),max(id1,id2))
+        if left is None:
+            left = -float("inf")
+        if right is None:
+            right = float("inf")
+        use = bystart if ( pair is None and self.byregion and ( left > -float("inf") or right < float("inf") ) ) else bypair
+        for i,(k,order,first1,first2,last1,last2,minstart,maxend,offset) in enumerate(self.index):
+            if order != use or maxend <= left or minstart >= right or (chrom is not None and k != chrom):
+                continue
+            if pair is not None and ( pair < (first1,first2) or pair > (last1,last2) ):
+                continue
+            id1s,id2s,starts,ends = self.chunk(i)
+            if pair is None:
+                lo,hi = 0,len(id1s)
+            else:
+                # the pair is contiguous in here
+                lo = bisectpair(id1s,id2s,pair,0,len(id1s))
+                hi = bisectpair(id1s,id2s,(pair[0],pair[1]+1),lo,len(id1s))
+            for j in xrange(lo,hi):
+                if ends[j] > left and starts[j] < right:
+                    yield id1s[j],id2s[j],starts[j],ends[j]
+
+    def blocks(self):
+        '''Iterate over (id1,id2,start,end), sorted.'''
+        return heapq.merge( *[ self.query(chrom=k) for k in self.chroms() ] )
+
+    def iterlines(self):
+        yield "id1 id2 start end\n"
+        for block in self.blocks():
+            yield " ".join(map(str,block)) + "\n"
+
+    def __iter__(self):
+        return self.lines
+
+    def next(self):
+        return self.lines.next()
+
+    def readline(self):
+        return next(self.lines,"")
+
+    def close(self):
+        self.map.close()
+        self.fobj.close()
+
+
+def bisectpair(id1s,id2s,pair,lo,hi):
+    '''The first index in [lo,hi) at which (id1s[i],id2s[i]) >= pair, if these are sorted.'''
+    while lo < hi:
+        mid = (lo+hi)//2
+        if (id1s[mid],id2s[mid]) < pair:
+            lo = mid+1
+        else:
+            hi = mid
+    return lo
+
+
 def fileopt(fname,opts):
     '''Return the file referred to by fname, open with options opts;
-    if fname is "-" return stdin/stdout; if fname ends with .gz run it through gzip.
+    if fname is "-" return stdin/stdout; if fname ends with .gz run it through gzip
+    (at level gziplevel, in a background thread: see GzipWriter and GzipReader);
+    if fname ends with .fibdb use the binary IBD format (see IBDWriter and IBDReader);
+    and if it ends with .fibdx use the indexed IBD format (see IBDStoreWriter and IBDStore).
     '''
     if fname == "-":
         if opts == "r":
@@ -294,8 +2153,23 @@ def fileopt(fname,opts):
             fobj = sys.stdout
         else:
             print "Something not right here."
+    elif fname.endswith(".fibdb"):
+        if "w" in opts:
+            fobj = IBDWriter(fname)
+        else:
+            fobj = IBDReader(fname)
+    elif fname.endswith(".fibdx"):
+        if "w" in opts:
+            fobj = IBDStoreWriter(fname)
+        else:
+            fobj = IBDStore(fname)
     elif fname[len(fname)-3:len(fname)]==".gz":
-        fobj = gzip.open(fname,opts)
+        if opts in ("w","wb"):
+            fobj = GzipWriter(fname)
+        elif opts in ("r","rb"):
+            fobj = GzipReader(fname)
+        else:
+            fobj = gzip.open(fname,opts)
     else:
-        fobj = open(fname,opts)
+        fobj = open(fname,opts,iobufsize)
     return fobj
@@ -0,0 +1,24 @@
+#!/usr/bin/python
+description='''Combine the IBD files from runs of sim-ibd-pedigree.py on consecutive windows of the genome
+    (with -x, and all with the same seed, -r) into one file,
+    pasting back together blocks that were split where the windows meet.
+    Files must be given in order along the genome.
+
+    Example usage:
+        python sim-ibd-pedigree.py -i sim-demographics-2.py -r 17 -x 1-11 -b test-1.fibd.gz -l test-1.log
+        python sim-ibd-pedigree.py -i sim-demographics-2.py -r 17 -x 12-22 -b test-2.fibd.gz -l test-2.log
+        python merge-ibd-shards.py -o test.fibd.gz -e 0.005 test-1.fibd.gz test-2.fibd.gz
+    (here the windows meet between chromosomes, so no cuts are needed).
+'''
+
+from optparse import OptionParser
+import coalpedigree as coal
+
+parser = OptionParser(description=description,usage="%prog [options] ibdfile1 ibdfile2 ...")
+parser.add_option("-o","--outfile",dest="outfile",help="name of file to write merged ibd to (or '-' for stdout)",default="-")
+parser.add_option("-c","--cuts",dest="cuts",help="positions (in Morgans, comma-separated) where the windows meet inside chromosomes",default="")
+parser.add_option("-e","--minlen",dest="minlen",help="minimum length of pasted-together IBD blocks to keep IN MORGANS (should be the same as for the runs)",default=0.005)
+(options,args) =  parser.parse_args()
+
+cuts = [ float(x) for x in options.cuts.split(",") if x.strip() ]
+coal.mergeibd(args,options.outfile,cuts=cuts,minlen=float(options.minlen))
@@ -2,21 +2,33 @@
 description='''Merge any adjacent blocks that are separated by no more than the distance gap_threshold.
 Output is one line per tract per pair of individuals, with positions of start and end of tract.
 
-Warning: this reads the entire file into memory at once.
+This splits the blocks by pair into a number of temporary files, and then sorts and merges each of these
+(in parallel, with -p) in a single pass, writing out the results as they are done, so memory use is bounded.
+With -m, it instead reads the entire file into memory at once, comparing each block to all earlier ones of its pair;
+this uses the same rule, and gives the same result if the blocks are in order of start within each pair
+(as the default does by sorting them first; otherwise, which blocks merge can depend on the order).
 '''
 # highly modified by plr from process-ibd.py by Browning
 
 import sys, gzip
+import os, shutil, tempfile
+import multiprocessing
+import itertools as it
 from math import isnan
 import re
 import coalpedigree as coal
 from optparse import OptionParser
 
 parser = OptionParser(description=description)
-parser.add_option("-b","--ibdfile",dest="ibdfile",help="name of file to read ibd from (or '-' for stdin)",default="-")
+parser.add_option("-b","--ibdfile",dest="ibdfile",help="name of file to read ibd from (or '-' for stdin); may be gzipped text (.gz), binary (.fibdb), or indexed (.fibdx)",default="-")
 parser.add_option("-o","--outfile",dest="outfile",help="name of file to output merged ibd from (or '-' for stdout)",default="-")
 parser.add_option("-g","--gaplen",dest="gaplen",help="merge blocks separated by a block no longer than this long (in MORGANS)", default=0.0)
 parser.add_option("-c","--chromfile",dest="chromfile",help="file to parse chromosome lengths from (e.g. logfile for that run)", default=None)
+parser.add_option("-p","--nprocs",dest="nprocs",help="number of processes to use", default=1)
+parser.add_option("-k","--nparts",dest="nparts",help="number of pieces to split the blocks into", default=16)
+parser.add_option("-s","--chunksize",dest="chunksize",help="number of blocks to sort in memory at once", default=10**6)
+parser.add_option("-t","--tmpdir",dest="tmpdir",help="where to put temporary files", default=None)
+parser.add_option("-m","--inmemory",dest="inmemory",action="store_true",help="do it all in memory (the old way)", default=False)
 (options,args) =  parser.parse_args()
 
 # size of maximum gap to merge
@@ -25,7 +37,7 @@ gapthresh = float(options.gaplen)
 # find chromosome lengths
 try:
     if options.chromfile is None:
-        chromfile = coal.fileopt( re.sub("\.fibd\.gz$",".log",options.ibdfile), "r")
+        chromfile = coal.fileopt( re.sub("\.fibd(\.gz|b|x)$",".log",options.ibdfile), "r")
     else:
         chromfile = coal.fileopt(options.chromfile,"r")
 except:
@@ -39,51 +51,102 @@ try:
     chrstartends = zip( [0.0]+chrends[:-1], chrends )
 except NameError:
     raise ValueError("Can't find 'chromosome ending positions:' in chromfile.")
-    
+chrends = sorted(chrends)
+# chrends are full precision, but positions written as text have been rounded (by str),
+#   so don't split blocks at a chromosome end that is just this close to one of their ends
+splittol = 1e-8
 
-results = {}
 infile = coal.fileopt(options.ibdfile,"r")
 outfile = coal.fileopt(options.outfile,"w")
-for line in infile:
-    # note: what is read is NOT the "length" but it is different (by one position) than the output.  
-    # Beagle reports the starting (inclusive) and ending (exclusive) positions.
-    (id1, id2, start, end) = line.split()
-    if id1 == "id1":
-        # oops this is the header
-        continue
-    start = float(start)
-    end = float(end)
-    if (id1,id2) in results:
-        currentlist = results[(id1,id2)]
-        markremove = [False for x in currentlist]
-        for j in range(len(currentlist)):
-             x = currentlist[j]
-             ovlap = x[0]<=end and start<=x[1]
-             # is a gap?
-             gap = ( x[0] <= end+gapthresh ) and ( start <= x[1] + gapthresh )
-             # is shorter than an adjacent segment?
-             # gaplen is max( start1-end2, start2-end1 ) since the min is negative
-             gap = gap and ( max( x[0]-end, start-x[1] ) < max( end-start, x[1]-x[0] ) )
-             if ovlap or gap:
-                 # overlap
-                 markremove[j] = True
-                 start = min(x[0],start)
-                 end = max(x[1],end)
-        if sum(markremove):
-             results[(id1,id2)] = [x for x,r in zip(currentlist,markremove) if not r]
-        results[(id1,id2)].append([start,end])
-    else:
-        results[(id1,id2)] = [[start,end]]
 
-# Note: changed 'minscore' to 'score'.
-outfile.write("id1 id2 start end\n")
-for x in results:
-    # id1 = x[0]; id2 = x[1]
-    # on the same chromosome?
-    for y in results[x]:
-        # start,end = y
-        breakpoints = [ y[0] ] + [ z for z in chrends if y[0] < z and z < y[1] ] + [ y[1] ]
-        for k in xrange(len(breakpoints)-1):
-            outfile.write( " ".join(map(str,x) + map(str,breakpoints[k:(k+2)])) + "\n" )
+nparts = int(options.nparts)
+nprocs = int(options.nprocs)
+chunksize = int(options.chunksize)
+
+def mergepart(fname):
+    '''Sort, merge, and split at chromosome ends the blocks in one of the pieces, writing them to a new file, whose name is returned.'''
+    reader = coal.IBDReader(fname)
+    outname = fname.replace(".fibdb","-out.fibdb")
+    writer = coal.IBDWriter(outname,level=1)
+    merged = coal.mergegaps( coal.sortblocks( reader.blocks(), chunksize=chunksize, tmpdir=os.path.dirname(fname) ), gapthresh )
+    for block in coal.splitblocks( ( x[:4] for x in merged ), chrends, splittol ):
+        writer.writeblock(*block)
+    writer.close()
+    reader.close()
+    os.remove(fname)
+    return outname
+
+if not options.inmemory:
+    tmpdir = tempfile.mkdtemp(dir=options.tmpdir)
+    try:
+        # split up by pair
+        partnames = [ os.path.join(tmpdir,"part"+str(k)+".fibdb") for k in xrange(nparts) ]
+        writers = [ coal.IBDWriter(x,chunksize=2**14,level=1) for x in partnames ]
+        for block in coal.readblocks(infile):
+            writers[ hash(block[:2]) % nparts ].writeblock(*block)
+        for x in writers:
+            x.close()
+        # and write out each as it is done
+        outfile.write("id1 id2 start end\n")
+        writeblock = coal.blockwriter(outfile)
+        if nprocs > 1:
+            pool = multiprocessing.Pool(nprocs)
+            outnames = pool.imap_unordered( mergepart, partnames )
+        else:
+            outnames = it.imap( mergepart, partnames )
+        for outname in outnames:
+            reader = coal.IBDReader(outname)
+            for block in reader.blocks():
+                writeblock(*block)
+            reader.close()
+            os.remove(outname)
+        if nprocs > 1:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(tmpdir)
+else:
+    results = {}
+    for line in infile:
+        # note: what is read is NOT the "length" but it is different (by one position) than the output.  
+        # Beagle reports the starting (inclusive) and ending (exclusive) positions.
+        (id1, id2, start, end) = line.split()
+        if id1 == "id1":
+            # oops this is the header
+            continue
+        start = float(start)
+        end = float(end)
+        if (id1,id2) in results:
+            currentlist = results[(id1,id2)]
+            markremove = [False for x in currentlist]
+            for j in range(len(currentlist)):
+                 x = currentlist[j]
+                 ovlap = x[0]<=end and start<=x[1]
+                 # is a gap?
+                 gap = ( x[0] <= end+gapthresh ) and ( start <= x[1] + gapthresh )
+                 # is shorter than an adjacent segment?
+                 # gaplen is max( start1-end2, start2-end1 ) since the min is negative
+                 gap = gap and ( max( x[0]-end, start-x[1] ) < max( end-start, x[1]-x[0] ) )
+                 if ovlap or gap:
+                     # overlap
+                     markremove[j] = True
+                     start = min(x[0],start)
+                     end = max(x[1],end)
+            if sum(markremove):
+                 results[(id1,id2)] = [x for x,r in zip(currentlist,markremove) if not r]
+            results[(id1,id2)].append([start,end])
+        else:
+            results[(id1,id2)] = [[start,end]]
+
+    # Note: changed 'minscore' to 'score'.
+    outfile.write("id1 id2 start end\n")
+    for x in results:
+        # id1 = x[0]; id2 = x[1]
+        # on the same chromosome?
+        for y in results[x]:
+            # start,end = y
+            breakpoints = [ y[0] ] + [ z for z in chrends if y[0]+splittol < z and z < y[1]-splittol ] + [ y[1] ]
+            for k in xrange(len(breakpoints)-1):
+                outfile.write( " ".join(map(str,x) + map(str,breakpoints[k:(k+2)])) + "\n" )
 
 outfile.close()
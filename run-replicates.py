@@ -0,0 +1,91 @@
+#!/usr/bin/python
+description='''Run a number of replicate simulations of one demography with sim-ibd-pedigree.py,
+    several at once but keeping the total (estimated) memory use under a budget.
+    Each replicate gets its own seed and output files, prefix-00001.fibd.gz and prefix-00001.log, etc;
+    the seed is passed to sim-ibd-pedigree.py as -c, or as -r if -x or -p is passed on (since these need it).
+    and a table of seeds, exit statuses (negative if killed by a signal), timings and sizes is written to prefix-manifest.txt as they finish.
+    Any further arguments (after --) are passed on to sim-ibd-pedigree.py.
+
+    Example usage:
+        python run-replicates.py -i sim-demographics-2.py -n 20 -t 150 -p 4 -m 16000 -o runs/growing-migration-2 -- -e .001
+'''
+
+from optparse import OptionParser
+import coalpedigree as coal
+import subprocess, os, sys
+import time
+import random
+from array import array
+
+parser = OptionParser(description=description,usage="%prog [options] [-- sim-ibd-pedigree.py options]")
+parser.add_option("-i","--infile",dest="infile",help="name of input file to get parameters from")
+parser.add_option("-n","--nreps",dest="nreps",help="number of replicates",default="1")
+parser.add_option("-t","--ngens",dest="ngens",help="total number of generations to simulate",default="10")
+parser.add_option("-o","--prefix",dest="prefix",help="prefix for output files",default="replicate")
+parser.add_option("-p","--nprocs",dest="nprocs",help="maximum number of replicates to run at once",default="1")
+parser.add_option("-m","--memory",dest="memory",help="total memory budget, in megabytes (default: no limit)",default=None)
+parser.add_option("-s","--memeach",dest="memeach",help="memory needed by each replicate, in megabytes (default: estimated from sample sizes and ngens)",default=None)
+parser.add_option("-r","--seed",dest="seed",help="seed to derive the replicates' seeds from (default: random)",default=None)
+parser.add_option("-z","--suffix",dest="suffix",help="file ending for ibd output",default=".fibd.gz")
+(options,args) =  parser.parse_args()
+
+nreps = int(options.nreps)
+ngens = int(options.ngens)
+nprocs = int(options.nprocs)
+seed = int(options.seed) if options.seed is not None else random.getrandbits(63)
+
+# to estimate memory usage (see sim-ibd-pedigree.py)
+if options.infile.endswith(".json"):
+    sampsizes = coal.readdemography(options.infile).sampsizes
+else:
+    infile = coal.fileopt(options.infile,"r")
+    exec(infile.read())
+    infile.close()
+if options.memeach is not None:
+    memeach = float(options.memeach)
+else:
+    nbreaks = coal.ploidy * sum(sampsizes.values()) * ( ngens*coal.chrlen + len(coal.chrlens) )
+    # the arrays in pop, twice over while parents() makes the new ones, and the interpreter
+    memeach = ( 2 * nbreaks * ( array(coal.postype).itemsize + array(coal.anctype).itemsize ) ) / 2.0**20 + 50
+memory = float(options.memory) if options.memory is not None else float("inf")
+
+# seeding python's random (-c) is much quicker than reproducible random numbers per meiosis (-r),
+#   which are only needed to simulate a window (-x) or in parallel (-p)
+seedopt = "-r" if any( [ a.split("=")[0] in ("-x","--window","-p","--nprocs") or a[:2] in ("-x","-p") for a in args ] ) else "-c"
+
+simscript = os.path.join( os.path.dirname(os.path.abspath(sys.argv[0])), "sim-ibd-pedigree.py" )
+outdir = os.path.dirname(options.prefix)
+if outdir and not os.path.exists(outdir):
+    os.makedirs(outdir)
+
+manifest = open(options.prefix + "-manifest.txt","w")
+manifest.write("# run-replicates.py " + " ".join(sys.argv[1:]) + "\n")
+manifest.write("# estimated memory per replicate: " + str(memeach) + " MB\n")
+manifest.write(" ".join(["replicate","seed","status","seconds","maxrss.MB","ibdfile","ibd.MB","logfile"]) + "\n")
+manifest.flush()
+
+def megabytes(fname):
+    return os.path.getsize(fname)/2.0**20 if os.path.exists(fname) else float("nan")
+
+running = {}  # pid : (replicate, seed, ibdfile, logfile, start time, process)
+todo = range(1,nreps+1)
+while todo or running:
+    # start as many as fit (but always at least one)
+    while todo and len(running) < nprocs and ( not running or (len(running)+1)*memeach <= memory ):
+        rep = todo.pop(0)
+        repseed = coal.splitmix( seed ^ rep ) >> 1
+        stem = options.prefix + "-" + ("%05d" % rep)
+        ibdfile, logfile = stem + options.suffix, stem + ".log"
+        proc = subprocess.Popen( [ sys.executable, simscript, "-i", options.infile, "-t", str(ngens), seedopt, str(repseed), "-b", ibdfile, "-l", logfile ] + args )
+        running[proc.pid] = ( rep, repseed, ibdfile, logfile, time.time(), proc )
+    pid, status, rusage = os.wait4(-1,0)
+    if pid not in running:
+        continue
+    rep, repseed, ibdfile, logfile, starttime, proc = running.pop(pid)
+    # the exit code, or minus the signal that killed it (as for subprocess)
+    status = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    proc.returncode = status  # so it doesn't get waited on again
+    manifest.write( " ".join( map( str, [ rep, repseed, status, time.time()-starttime, rusage.ru_maxrss/1024.0, ibdfile, megabytes(ibdfile), logfile ] ) ) + "\n" )
+    manifest.flush()
+
+manifest.close()
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 description = '''Simulate IBD segments in a diploid population.
-    infile should contain code defining
+    infile should either be a JSON file ending in .json describing the demography (see Demography in coalpedigree.py),
+    or contain code defining
        sampsizes -- a dict whose values are the sample sizes
        ancnefn(t) -- a function returning a dict whose keys are population names and whose values are effective population sizes in generation t
        migprobs(t) -- a function returning a dict whose keys are pairs (tuples) of population names (x,y) 
@@ -12,12 +13,12 @@ description = '''Simulate IBD segments in a diploid population.
     Peak memory usage is:
         pop: [ number of breakpoints in sample ] -> float
             and  [ number of breakpoints in sample ] -> int
-        recombdict: [ number of breakpoints in ancestors ] -> float
-        parentdict: ploidy * [ number of ancestors ] -> int
+        crossovers: [ number of breakpoints in ancestors ] -> float
+        parents: ploidy * [ number of ancestors ] -> int
         and [ number of breakpoints in sample ] = x =
             ploidy * (number of samples) * ( (number of generations)*(total genome length) + (number of chromosomes) )
         and [ number of ancestors ] ~ [ effective pop size ] * ( 1- exp(-[number of samples]/[effective pop size]) )
-        and [ number of breakpoints in ancestors ] = ploidy * ( total genome length + number of chromosome ) * [ number of ancestors ]
+        and [ number of breakpoints in ancestors ] = ploidy * ( total genome length ) * [ number of ancestors ]
 
     Example:
           python sim-ibd-pedigree.py -i sim-demographics-2.py -t 10 -b test.ibd.gz -l test.log
@@ -29,12 +30,15 @@ import re
 import time
 import subprocess, os, sys
 import signal
+import random
+import json
+import resource
 # import pdb
 
 
 parser = OptionParser(description=description)
 # parser.add_option("-c","--coalfile",dest="coalfile",help="name of file to write final coalescent info to (or '-' for stdout)",default="-")
-parser.add_option("-b","--ibdfile",dest="ibdfile",help="name of file to write final ibd blocks to (or '-' for stdout)",default="-")
+parser.add_option("-b","--ibdfile",dest="ibdfile",help="name of file to write final ibd blocks to (or '-' for stdout); ending in .gz for gzipped text, .fibdb for compact binary, or .fibdx for binary sorted and indexed by pair and by position on each chromosome (see IBDStore)",default="-")
 parser.add_option("-l","--logfile",dest="logfile",help="name of log file (or '-' for stdout)",default="-")
 parser.add_option("-i","--infile",dest="infile",help="name of input file to get parameters from (or '-' for stdin)")
 parser.add_option("-t","--ngens",dest="ngens",help="total number of generations to simulate",default="10")
@@ -43,6 +47,22 @@ parser.add_option("-m","--migprob",dest="migprob",help="migration probability")
 parser.add_option("-s","--samplesizes",dest="sampsizes",help="sample sizes")
 parser.add_option("-e","--minlen",dest="minlen",help="minimum length of IBD block to record IN MORGANS (default value 0.005M = 0.5cM)",default=None)
 parser.add_option("-g","--gaplen",dest="gaplen",help="gap length, IN MORGANS: blocks closer together than this will be recorded even if shorter than minlen (default value 0.5M = 50cM)",default=None)
+parser.add_option("-w","--stream",dest="stream",action="store_true",help="write out IBD blocks as they form during the simulation rather than all at the end; minlen and gaplen are not applied, and blocks formed in different generations may abut (merge with e.g. remove-gaps-fibd.py -g 0)",default=False)
+parser.add_option("-p","--nprocs",dest="nprocs",help="number of processes to simulate with (implies -r) and to write out IBD blocks with, one chromosome at a time (needs -b; gaplen then only applies within chromosomes)",default="1")
+parser.add_option("-c","--rngseed",dest="rngseed",help="seed for python's random number generator, for a reproducible run that is as fast as an unseeded one (unlike -r), but whose random numbers depend on the number of processes and the window",default=None)
+parser.add_option("-r","--seed",dest="seed",help="seed for reproducible random numbers that do not depend on the number of processes (default: chosen randomly if -p is more than 1)",default=None)
+parser.add_option("-k","--shards",dest="shards",action="store_true",help="with -p, write blocks for each chromosome to a separate file, e.g. out.chr1.fibd.gz",default=False)
+parser.add_option("-x","--window",dest="window",help="only simulate this part of the genome: either 'left,right' (in Morgans) or a range of chromosomes, e.g. '3-5'; needs -r, and with the same seed, separate runs on different windows can be combined with merge-ibd-shards.py",default=None)
+parser.add_option("-z","--checkpoint",dest="checkpoint",help="name of file to save the state of the simulation to, periodically and at the end (see -y, -j, and -u)",default=None)
+parser.add_option("-y","--checkgens",dest="checkgens",help="with -z, save a checkpoint every this many generations",default=None)
+parser.add_option("-j","--checkmins",dest="checkmins",help="with -z, save a checkpoint after any generation at least this many minutes after the last one",default=None)
+parser.add_option("-u","--resume",dest="resume",help="name of checkpoint file to continue a run from (with the same infile), up to -t generations in total; this gives the same result as if it had not stopped (but with -w, only blocks formed after the checkpoint are written)",default=None)
+parser.add_option("-q","--metrics",dest="metrics",help="name of file to write a line of JSON to each generation with timings, segment counts, and peak memory usage",default=None)
+parser.add_option("-f","--filters",dest="filters",help="filters to pass the blocks through before writing them out, e.g. 'minlen=.001,gaps=.05,chroms,minlen=.02' is like winnow.py -n .001 -g .05 -m .02 and then remove-gaps-fibd.py, but without the nsegs column, and merging blocks of a pair whichever order its ids are in (winnow.py does not); not applied with -w",default="")
+parser.add_option("-o","--summary",dest="summary",help="name of file to write a summary of the IBD blocks to as JSON (length histograms and counts by pair of populations, and total IBD between each pair of samples) instead of writing out the blocks themselves; -b is then ignored",default=None)
+parser.add_option("-d","--bins",dest="bins",help="with -o, left ends of the block length bins IN MORGANS, either comma-separated or 'from:to:by'",default="0:1:.01")
+parser.add_option("-v","--snapshots",dest="snapshots",help="generations to record IBD as of, comma-separated, e.g. '10,25,50': implies -w, simulates up to the last of these (ignoring -t), and adds a column, gen, giving the generation each block formed in (that of its common ancestor); so the IBD as of generation T is the blocks with gen <= T (see winnow.py -a); needs text output",default=None)
+parser.add_option("-a","--lineages",dest="lineages",action="store_true",help="keep track of distinct ancestral lineages rather than of sample segments (faster when Ne is small)",default=False)
 (options,args) =  parser.parse_args()
 
 
@@ -50,14 +70,70 @@ parser.add_option("-g","--gaplen",dest="gaplen",help="gap length, IN MORGANS: bl
 if options.infile is not None:
     infile = coal.fileopt(options.infile,"r")
     inparams = infile.read()
-    exec(inparams)
+    infile.close()
+    if options.infile.endswith(".json"):
+        # a declarative demography: see coal.Demography
+        demography = coal.readdemography(options.infile)
+        sampsizes = demography.sampsizes
+        ancnefn = demography.ancne
+        migprobs = demography.migprobs
+    else:
+        exec(inparams)
 
 # command line options supercede statements in infile
-ibdfile = coal.fileopt(options.ibdfile, "w")
+if options.summary is not None:
+    if options.stream or options.snapshots is not None:
+        raise ValueError("Can't summarize (-o) blocks that are written as they form (-w).")
+    bins = coal.parsebins(options.bins)
 # coalfile = coal.fileopt(options.coalfile, "w")
 logfile = coal.fileopt(options.logfile, "w")
+metricsfile = coal.fileopt(options.metrics, "w") if options.metrics is not None else None
 ngens = int(options.ngens)
+if options.snapshots is not None:
+    snapshots = sorted( map( int, options.snapshots.split(",") ) )
+    ngens = snapshots[-1]
+    options.stream = True
+nprocs = int(options.nprocs)
+filters = coal.parsefilters(options.filters)
+if nprocs > 1 and options.ibdfile == "-" and not options.stream and options.summary is None:
+    raise ValueError("Writing in parallel (-p) needs an output file (-b).")
+if options.summary is not None or ( nprocs > 1 and not options.stream ):
+    # writeibdparallel opens the output file(s) itself
+    ibdfile = None
+else:
+    ibdfile = coal.fileopt(options.ibdfile, "w")
+if options.rngseed is not None:
+    random.seed( int(options.rngseed) )
+if options.seed is not None:
+    seed = int(options.seed)
+elif nprocs > 1:
+    seed = random.getrandbits(63)
+else:
+    seed = None
+
+if options.window is None:
+    window = None
+else:
+    if seed is None:
+        raise ValueError("Simulating a window (-x) needs a seed (-r), so that all windows see the same pedigree.")
+    if "," in options.window:
+        window = tuple( map( float, options.window.split(",") ) )
+    else:
+        chroms = map( int, options.window.split("-") )
+        if not 1 <= chroms[0] <= chroms[-1] <= len(coal.chrpos)+1:
+            raise ValueError("The chromosomes in the window (-x) must be in order, and between 1 and " + str(len(coal.chrpos)+1) + ".")
+        window = ( coal.chromwindow(chroms[0]-1)[0], coal.chromwindow(chroms[-1]-1)[1] )
+    if len(window) != 2 or not 0.0 <= window[0] < window[1] <= coal.chrlen:
+        raise ValueError("The window (-x) must be left,right with 0 <= left < right <= " + str(coal.chrlen) + ", or a range of chromosomes.")
 
+if options.resume is not None:
+    # these come from the checkpoint
+    resumepop, resumestate = coal.readcheckpoint(options.resume)
+    seed = resumestate["seed"]
+    window = resumepop.window
+    options.lineages = isinstance(resumepop,coal.Lineages)
+checkgens = int(options.checkgens) if options.checkgens is not None else None
+checkmins = float(options.checkmins) if options.checkmins is not None else None
 if options.nesize is not None:
     ancnefn = lambda t: {}.fromkeys(pop.keys(),int(options.nesize))
 else:
@@ -124,7 +200,21 @@ def catch_int(signal,frame):
 signal.signal( signal.SIGINT, catch_int )
 
 # initialize
-pop = coal.initpop(sampsizes)
+if options.lineages:
+    pop = coal.initlineages(sampsizes,window)
+    census, censuslabel = coal.lineagecensus, "census (num lineages, num lineages by population, num segments carried): "
+    parents = lambda pop,**kwargs: coal.lineageparents(pop,seed=seed,**kwargs)
+else:
+    pop = coal.initpop(sampsizes,window)
+    census, censuslabel = coal.census, "census (num segments, num segments by population, num merged): "
+    parents = lambda pop,**kwargs: coal.parents(pop,seed=seed,nprocs=nprocs,**kwargs)
+
+if options.resume is not None:
+    pop = resumepop
+    random.setstate( resumestate["rngstate"] )
+    tstart = resumestate["t"]
+else:
+    tstart = 0
 
 # sanity checks
 mignames = reduce( lambda x,y: x+y, [ [u,v] for (u,v) in migprobs(t=1).keys() ] )
@@ -141,7 +231,11 @@ logfile.write("\n")
 logfile.write("options "+str(options)+"\n")
 logfile.write("\n")
 # logfile.write("coal output: " + str(options.coalfile)+"\n")
-logfile.write("ibd output: " + str(options.ibdfile)+"\n")
+if options.summary is not None:
+    logfile.write("ibd summary output: " + options.summary + "\n")
+    logfile.write("length bins: " + str(bins) + "\n")
+else:
+    logfile.write("ibd output: " + str(options.ibdfile)+"\n")
 logfile.write("input: " + str(options.infile)+"\n")
 logfile.write("--------------------------------\n")
 logfile.write(inparams)
@@ -150,34 +244,94 @@ logfile.write("ngens: " + str(ngens)+"\n")
 logfile.write("sampsizes: " + str(sampsizes)+"\n")
 logfile.write("minlen: " + str(minlen)+"\n")
 logfile.write("gaplen: " + str(gaplen)+"\n")
+logfile.write("seed: " + str(seed)+"\n")
+if options.rngseed is not None:
+    logfile.write("rngseed: " + options.rngseed + "\n")
+logfile.write("filters: " + options.filters+"\n")
+logfile.write("window: " + str(window)+"\n")
+if options.snapshots is not None:
+    logfile.write("snapshots: " + str(snapshots) + "\n")
+if options.resume is not None:
+    logfile.write("resuming from " + options.resume + " at generation " + str(tstart) + "\n")
 logfile.write("Ne at 1: " + str(ancnefn(t=1))+"\n")
 logfile.write("migprob at 1: " + str(migprobs(t=1))+"\n")
 logfile.write("chromosome ending positions: " + str(list(coal.chrpos)+[coal.chrlen]) + "\n")
 logfile.write("\n")
 logfile.write("Beginning ------------\n")
 
+if options.snapshots is not None:
+    writeto = coal.GenerationTagger(ibdfile)
+    ibdfile.write("id1 id2 start end gen\n")
+elif options.stream:
+    writeto = ibdfile
+    ibdfile.write("id1 id2 start end\n")
+else:
+    writeto = None
+
+def checkpoint(tdone):
+    coal.writecheckpoint(pop,options.checkpoint,t=tdone,rngstate=random.getstate(),seed=seed)
+    logfile.write("    saved checkpoint to " + options.checkpoint + " at " + time.strftime("%d %h %Y %H:%M:%S", time.localtime()) + "\n")
+
 # here is where the action happens
-for t in xrange(ngens):
+tdone = tstart
+lastcheck = time.time()
+for t in xrange(tstart,ngens):
     logfile.write("  t="+str(t)+"\n")
     if t%10==0:
-        logfile.write("    census (num segments, num indivs): " + str(coal.census(pop,sampsizes=sampsizes))+ "\n")
+        logfile.write("    " + censuslabel + str(census(pop,sampsizes=sampsizes))+ "\n")
     logfile.flush()
-    coal.parents(pop,ancne=ancnefn(t),migprobs=migprobs(t),t=t)
+    metrics = {}
+    if options.snapshots is not None:
+        # blocks formed now have their common ancestor in generation t+1
+        writeto.gen = t+1
+    parents(pop,ancne=ancnefn(t),migprobs=migprobs(t),t=t,writeto=writeto,metrics=metrics)
+    if metricsfile is not None:
+        # ru_maxrss is in kilobytes (on linux)
+        metrics.update( t=t, maxrss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0, childmaxrss=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024.0 )
+        metricsfile.write( json.dumps(metrics,sort_keys=True) + "\n" )
+        metricsfile.flush()
+    tdone = t+1
+    if options.snapshots is not None and tdone in snapshots:
+        ibdfile.flush()
+        logfile.write("    IBD as of generation " + str(tdone) + " written (gen <= " + str(tdone) + ")\n")
+    if options.checkpoint is not None and tdone < ngens and not _exitnow:
+        if (checkgens and tdone%checkgens==0) or (checkmins and time.time()-lastcheck >= 60*checkmins):
+            checkpoint(tdone)
+            lastcheck = time.time()
     if _exitnow:
         # there's been a ctrl-c; stop now.
         break
 
-logfile.write("    census (num indivs, num segments): " + str(coal.census(pop,sampsizes=sampsizes))+ "\n")
-logfile.write("Done with simulation at " + time.strftime("%d %h %Y %H:%M:%S", time.localtime()) + "; now writing out IBD info.\n" )
+if options.checkpoint is not None:
+    # so that the run can be extended later
+    checkpoint(tdone)
 
-coal.writeibd(pop,minlen=minlen,gaplen=gaplen,outfile=ibdfile)
+logfile.write("    " + censuslabel + str(census(pop,sampsizes=sampsizes))+ "\n")
+if options.stream:
+    logfile.write("Done with simulation at " + time.strftime("%d %h %Y %H:%M:%S", time.localtime()) + ".\n" )
+else:
+    logfile.write("Done with simulation at " + time.strftime("%d %h %Y %H:%M:%S", time.localtime()) + "; now writing out IBD info.\n" )
+    if options.lineages:
+        pop = coal.lineagestopop(pop)
+    if options.summary is not None:
+        summary = coal.writesummary(pop,sampsizes,bins,minlen=minlen,gaplen=gaplen,filename=options.summary,nprocs=nprocs,filters=filters)
+        logfile.write("Summarized " + str(summary["nblocks"]) + " blocks in " + options.summary + "\n")
+    elif nprocs > 1:
+        written = coal.writeibdparallel(pop,minlen=minlen,gaplen=gaplen,filename=options.ibdfile,nprocs=nprocs,shards=options.shards,filters=filters)
+        logfile.write("Wrote " + " ".join(written) + "\n")
+    else:
+        coal.writeibd(pop,minlen=minlen,gaplen=gaplen,outfile=ibdfile,filters=filters)
 # writecoal(ibdict,outfile=coalfile)
 # pdb.set_trace()
 
 logfile.write("\n")
 logfile.write("Closing ibd file...\n")
 
-ibdfile.close()
+if ibdfile is not None:
+    ibdfile.close()
+
+if metricsfile is not None:
+    metricsfile.close()
 
 logfile.write("All done at " + time.strftime("%d %h %Y %H:%M:%S", time.localtime()) + "\n" )
 # coalfile.close()
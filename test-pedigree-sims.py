@@ -157,3 +157,38 @@ tracer = trace.Trace(trace=0,count=1)
 tracer.run(stmt)
 r = tracer.results()
 r.write_results(show_missing=True, coverdir="/tmp")
+
+
+####### mergegaps (as used by winnow.py -s) should agree with winnow.py's default, list-based, merge
+
+def listmerge(blocks,gaplen):
+    # as in winnow.py without -s
+    results = {}
+    for id1,id2,start,end in blocks:
+        currentlist = results.setdefault((id1,id2),[])
+        markremove = [False for x in currentlist]
+        for j in range(len(currentlist)):
+            x = currentlist[j]
+            ovlap = x[0]<=end and start<=x[1]
+            gap = ( ( x[0]<=end+gaplen ) and ( start<=x[1]+gaplen ) )
+            gap = ( gap and ( max( x[0]-end, start-x[1] ) < max( end-start, x[1]-x[0] ) ) )
+            if ovlap or gap:
+                markremove[j] = True
+                start = min(x[0],start)
+                end = max(x[1],end)
+        nsegs = 1 + sum( [ x[2] for x,r in zip(currentlist,markremove) if r] )
+        results[(id1,id2)] = [x for x,r in zip(currentlist,markremove) if not r] + [(start,end,nsegs)]
+    return sorted( [ x+y for x in results for y in results[x] ] )
+
+# a block that only merges with an earlier one once a later one has been added to it
+blocks = [ (1,2,0.0,0.1), (1,2,0.3,0.31), (1,2,0.31,1.0) ]
+assert list( coal.mergegaps(blocks,0.5) ) == listmerge(blocks,0.5) == [ (1,2,0.0,1.0,3) ]
+
+for rep in xrange(1000):
+    blocks = []
+    for k in xrange(random.randint(1,30)):
+        start = round(random.random(),2)
+        blocks.append( (random.randint(1,2),3,start,start+round(random.expovariate(random.choice([5,20,100])),2)) )
+    blocks.sort()
+    gaplen = random.choice([0.0,.01,.05,.2,.5])
+    assert list( coal.mergegaps(blocks,gaplen) ) == listmerge(blocks,gaplen)
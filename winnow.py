@@ -2,6 +2,10 @@
 description='''Take a file of IBD blocks and run it through something like the detection procudure:
     merge together nearby blocks and retain only those above a certain length.
 
+    By default this reads the entire file into memory at once, and for each block compares it to all others of the same pair.
+    With -s, blocks are instead sorted by pair and position (in chunks of a limited size, on disk, unless -r says they already are)
+    and merged in a single pass, using bounded memory.
+
     Example usage:
         python winnow.py -b this-ibdfile.fibd.gz -o this-ibdfile-winnowed.fibd.gz -l this-ibdfile-winnowed.log -g .05 -m .02
 '''
@@ -10,17 +14,25 @@ from optparse import OptionParser
 import coalpedigree as cp
 
 parser = OptionParser(description=description)
-parser.add_option("-b","--ibdfile",dest="ibdfile",help="name of file to read ibd from (or '-' for stdout)",default="-")
+parser.add_option("-b","--ibdfile",dest="ibdfile",help="name of file to read ibd from (or '-' for stdout); may be gzipped text (.gz), binary (.fibdb), or indexed (.fibdx)",default="-")
 parser.add_option("-o","--outfile",dest="outfile",help="name of output ibd file (or '-' for stdin)")
 parser.add_option("-l","--logfile",dest="logfile",help="name of log file (or '-' for stdout)",default="-")
 parser.add_option("-n","--minminlen",dest="minminlen",help="totally ignore any blocks shorter than this length", default=0.0)
 parser.add_option("-g","--gaplen",dest="gaplen",help="merge blocks separated by a block no longer than this long", default=0.0)
 parser.add_option("-m","--minlen",dest="minlen",help="only keep any blocks (including merged ones) at least this long", default=0.0)
+parser.add_option("-s","--stream",dest="stream",action="store_true",help="sort the blocks and merge them in one pass", default=False)
+parser.add_option("-r","--presorted",dest="presorted",action="store_true",help="with -s, the input is already sorted by id1, id2, and start", default=False)
+parser.add_option("-k","--chunksize",dest="chunksize",help="with -s, number of blocks to sort in memory at once", default=10**6)
+parser.add_option("-a","--asof",dest="asof",help="with -s, only use blocks formed no more than this many generations ago (from the gen column written by sim-ibd-pedigree.py -v)", default=None)
+parser.add_option("-t","--tmpdir",dest="tmpdir",help="with -s, where to put temporary files while sorting", default=None)
 (options,args) =  parser.parse_args()
 
 minminlen = float(options.minminlen)
 gaplen = float(options.gaplen)
 minlen = float(options.minlen)
+asof = int(options.asof) if options.asof is not None else None
+if asof is not None and not options.stream:
+    raise ValueError("Choosing blocks by generation (-a) needs sorting and merging in one pass (-s).")
 
 ibdfile = cp.fileopt(options.ibdfile, "r")
 outfile = cp.fileopt(options.outfile, "w")
@@ -35,6 +47,8 @@ logfile.write("writing to " + options.outfile + "\n")
 logfile.write("totally ignoring blocks below: " + str(minminlen) + "\n")
 logfile.write("merging closer than gaplen: " + str(gaplen) + "\n")
 logfile.write("outputting merged blocks longer than: " + str(minlen) + "\n")
+if asof is not None:
+    logfile.write("using blocks formed by generation: " + str(asof) + "\n")
 
 nin = 0
 nskip = 0
@@ -42,42 +56,62 @@ nout = 0
 
 header = ibdfile.readline().split()
 
-for line in ibdfile:
-    (id1, id2, start, end) = line.split()
-    start = float(start)
-    end = float(end)
-    if end-start < minminlen:
-        nskip = nskip + 1
-        continue
-    nin = nin + 1
-    if (id1,id2) in results:
-        currentlist = results[(id1,id2)]
-        markremove = [False for x in currentlist]
-        for j in range(len(currentlist)):
-            x = currentlist[j]
-            ovlap = x[0]<=end and start<=x[1]
-            # is a gap?
-            gap = ( ( x[0]<=end+gaplen ) and ( start<=x[1]+gaplen ) )
-            # is shorter than an adjacent segment?
-            # gaplen is max( start1-end2, start2-end1 ) since the min is negative
-            gap = ( gap and ( max( x[0]-end, start-x[1] ) < max( end-start, x[1]-x[0] ) ) )
-            if ovlap or gap:
-                # overlap
-                markremove[j] = True
-                start = min(x[0],start)
-                end = max(x[1],end)
-        nsegs = 1 + sum( [ x[2] for x,r in zip(currentlist,markremove) if r] )
-        if sum(markremove):
-            results[(id1,id2)] = [x for x,r in zip(currentlist,markremove) if not r]
-        results[(id1,id2)].append([start,end,nsegs])
-    else:
-        results[(id1,id2)] = [[start,end,1]]
+if options.stream:
+    def inblocks():
+        global nin, nskip
+        for block in cp.readblocks(ibdfile, asof=asof):
+            if block[3]-block[2] < minminlen:
+                nskip = nskip + 1
+                continue
+            nin = nin + 1
+            yield block
+    blocks = inblocks()
+    if not options.presorted:
+        blocks = cp.sortblocks( blocks, chunksize=int(options.chunksize), tmpdir=options.tmpdir )
+    outfile.write("id1 id2 start end nsegs\n")
+    for block in cp.mergegaps( blocks, gaplen ):
+        if block[3]-block[2] >= minlen:
+            nout = nout+1
+            outfile.write( " ".join(map(str,block))+"\n" )
+else:
+    for line in ibdfile:
+        (id1, id2, start, end) = line.split()[:4]
+        start = float(start)
+        end = float(end)
+        if end-start < minminlen:
+            nskip = nskip + 1
+            continue
+        nin = nin + 1
+        if (id1,id2) in results:
+            currentlist = results[(id1,id2)]
+            markremove = [False for x in currentlist]
+            for j in range(len(currentlist)):
+                x = currentlist[j]
+                ovlap = x[0]<=end and start<=x[1]
+                # is a gap?
+                gap = ( ( x[0]<=end+gaplen ) and ( start<=x[1]+gaplen ) )
+                # is shorter than an adjacent segment?
+                # gaplen is max( start1-end2, start2-end1 ) since the min is negative
+                gap = ( gap and ( max( x[0]-end, start-x[1] ) < max( end-start, x[1]-x[0] ) ) )
+                if ovlap or gap:
+                    # overlap
+                    markremove[j] = True
+                    start = min(x[0],start)
+                    end = max(x[1],end)
+            nsegs = 1 + sum( [ x[2] for x,r in zip(currentlist,markremove) if r] )
+            if sum(markremove):
+                results[(id1,id2)] = [x for x,r in zip(currentlist,markremove) if not r]
+            results[(id1,id2)].append([start,end,nsegs])
+        else:
+            results[(id1,id2)] = [[start,end,1]]
 
-outfile.write("id1 id2 start end nsegs\n")
-for x in results:
-    id1 = x[0]; id2 = x[1]
-    for y in results[x]:
-        nout = nout+1
-        outfile.write( " ".join(map(str,x) + map(str,y))+"\n" )
+    outfile.write("id1 id2 start end nsegs\n")
+    for x in results:
+        id1 = x[0]; id2 = x[1]
+        for y in results[x]:
+            if y[1]-y[0] < minlen:
+                continue
+            nout = nout+1
+            outfile.write( " ".join(map(str,x) + map(str,y))+"\n" )
 
 logfile.write("Done merging " + str(nin) + " blocks into " + str(nout) + " blocks; totally omitted " + str(nskip) + " blocks.\n" )